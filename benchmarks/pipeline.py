@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+Synthetic load benchmark for the gwtop collect -> summarize -> sort ->
+render pipeline.
+
+Synthetic collectors stand in for the PCP collectors, writing a sample for
+a configurable number of gateways x LUNs each refresh (with a given fraction
+of the LUNs active), so no pmcd, rtslib or ceph is needed. Each LUN count is
+run in a separate process, and the time spent in each stage and the growth
+in RSS are reported per refresh.
+
+  python benchmarks/pipeline.py --luns 100,1000,10000 --gateways 4
+"""
+
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from gwtop.config.generic import Config, GatewayMetrics
+from gwtop.collectors.layout import layout_lookup
+from gwtop.UI.datamanager import (summarize, smoothed_fields,
+                                  percentiles_needed)
+from gwtop.UI.screen import Screen
+from gwtop.UI.textmode import TextMode
+from gwtop.utils.barrier import EpochBarrier
+from gwtop.utils.devfilter import DeviceFilter
+from gwtop.utils.histogram import LatencyTracker
+from gwtop.utils.profiler import Profiler
+from gwtop.utils.samples import SampleRing
+from gwtop.utils.smoothing import RateSmoother, RATE_CHOICES
+
+# NB. render is show_stats, which includes it's own sort of the LUNs
+STAGES = ['collect', 'summarize', 'sort', 'render']
+
+
+class NullOutput(object):
+    """ discard the rendered frames """
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class SyntheticCollector(object):
+    """
+    Stand-in for a PCPcollector, holding the same metrics object and sample
+    ring, populated with random values
+    """
+
+    def __init__(self, hostname, provider, devices, churn):
+        self.hostname = hostname
+        self.collector = layout_lookup[provider]
+        self.disk_attr = self.collector.disk_attr
+        self.churn = churn
+        self.listeners = []
+
+        self.metrics = GatewayMetrics()
+        self.metrics.hostname = hostname
+        self.metrics.epoch = -1
+        self.metrics.cpu_busy_pct = 0
+        self.metrics.nic_bytes = {'in': 0, 'out': 0}
+        self.metrics.samples = SampleRing(sorted(self.disk_attr),
+                                          sorted(devices))
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def sample(self, epoch, interval):
+        """ write a sample, with a random subset of the LUNs active """
+
+        samples = self.metrics.samples
+        rows = len(samples)
+        active = random.sample(xrange(rows), int(rows * self.churn))
+
+        samples.begin()
+        for row in active:
+            values = dict((attr, random.random() * 100)
+                          for attr in self.disk_attr)
+            if 'reads' in values and 'writes' in values:
+                # keep iops consistent with the reads/writes of this sample
+                values['iops'] = values['reads'] + values['writes']
+            for attr, value in values.items():
+                samples.put(attr, row, value)
+        samples.commit(epoch * interval, epoch)
+
+        self.metrics.epoch = epoch
+        self.metrics.cpu_busy_pct = random.random() * 100
+        self.metrics.nic_bytes = {'in': random.random() * 1e8,
+                                  'out': random.random() * 1e8}
+
+        for listener in self.listeners:
+            listener(self.metrics)
+
+
+def build_config(opts, num_luns):
+    """ return a config object equivalent to the one gwtop.py builds """
+
+    def lun_type(lun):
+        # the combined provider has a mix of TCMU and krbd backed LUNs
+        if opts.provider == 'combined':
+            return 'user' if lun % 2 else 'block'
+        return 'user' if opts.provider == 'lio' else 'block'
+
+    devices = dict(('rbd.image{:06d}'.format(lun),
+                    {"size": 1 << 30,
+                     "rbd_name": 'rbd{}'.format(lun),
+                     "lun_type": lun_type(lun)})
+                   for lun in range(num_luns))
+
+    gateways = ['gateway-{}'.format(gw) for gw in range(opts.gateways)]
+
+    config = Config()
+    config.devices = devices
+    config.sample_interval = 1
+
+    config.opts = Config()
+    config.opts.__dict__.update({"busy_only": opts.busy_only,
+                                 "sortkey": opts.sortkey,
+                                 "reverse": opts.top is not None,
+                                 "limit": opts.top,
+                                 "percentiles": opts.percentiles,
+                                 "rates": opts.rates,
+                                 "mode": 'text',
+                                 "scroll": True,
+                                 "replay": 'benchmark',
+                                 "archive": None,
+                                 "view": opts.view,
+                                 "provider": opts.provider})
+
+    config.gateway_config = Config()
+    config.gateway_config.gateways = gateways
+    config.gateway_config.diskmap = dict((devname, ['client']) for devname
+                                         in devices)
+    config.gateway_config.client_count = num_luns
+
+    config.profiler = Profiler()
+    config.device_generation = 0
+    config.consumed_epochs = {}
+    config.lun_filter = DeviceFilter()
+    config.latency = LatencyTracker()
+    layout = layout_lookup[opts.provider]
+    disk_attr = layout.disk_attr
+    config.lun_rates = RateSmoother(sorted(attr for attr in disk_attr
+                                           if disk_attr[attr]['sum_method'] == 'sum'),
+                                    config.sample_interval)
+    config.gateway_rates = RateSmoother(['cpu_busy', 'net_in', 'net_out'],
+                                        config.sample_interval)
+    config.rate_fields = smoothed_fields(config.opts, layout,
+                                         config.lun_rates)
+    config.lun_percentiles = percentiles_needed(config.opts, layout)
+    config.barrier = EpochBarrier(members=gateways, timeout=0,
+                                  interval=config.sample_interval)
+
+    return config
+
+
+def maxrss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_benchmark(opts, num_luns):
+    """
+    Run the pipeline for a given number of LUNs
+    :return: dict of stage -> list of elapsed times (secs), dict of
+    stage -> RSS growth (MB)
+    """
+
+    config = build_config(opts, num_luns)
+    collectors = []
+    for gw in config.gateway_config.gateways:
+        collector = SyntheticCollector(gw, opts.provider, config.devices,
+                                       opts.churn)
+        collector.add_listener(config.barrier.update)
+        collectors.append(collector)
+
+    ui = TextMode(config, collectors)
+    ui.screen = Screen(out=NullOutput(), redraw=False)
+
+    timings = dict((stage, []) for stage in STAGES)
+    rss_growth = dict((stage, 0.0) for stage in STAGES)
+
+    def timed(stage, func, *args):
+        rss = maxrss_mb()
+        start = time.time()
+        result = func(*args)
+        timings[stage].append(time.time() - start)
+        rss_growth[stage] += maxrss_mb() - rss
+        return result
+
+    def collect(epoch):
+        for collector in collectors:
+            collector.sample(epoch, config.sample_interval)
+
+    for epoch in range(opts.warmup + opts.refreshes):
+        if epoch == opts.warmup:
+            # discard the warm up refreshes
+            for stage in STAGES:
+                timings[stage] = []
+                rss_growth[stage] = 0.0
+
+        timed('collect', collect, epoch)
+        gw_stats, disk_summary = timed('summarize', summarize, config,
+                                       collectors)
+        timed('sort', ui.sort_stats, disk_summary, None, opts.top)
+        timed('render', ui.show_stats, gw_stats, disk_summary)
+
+    return timings, rss_growth
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def report(opts, num_luns, timings, rss_growth):
+    """ print the results for a LUN count """
+
+    total = [sum(stage_times) for stage_times in
+             zip(*[timings[stage] for stage in STAGES])]
+
+    print("{} LUNs x {} gateways, {:.0%} active, {} refreshes (rss "
+          "{:.1f}MB)".format(num_luns, opts.gateways, opts.churn,
+                             opts.refreshes, maxrss_mb()))
+    print("  {:<10} {:>10} {:>10} {:>10} {:>12}".format("stage", "mean ms",
+                                                         "p95 ms", "max ms",
+                                                         "rss +MB"))
+    for stage in STAGES + ['total']:
+        values = total if stage == 'total' else timings[stage]
+        growth = sum(rss_growth.values()) if stage == 'total' \
+            else rss_growth[stage]
+        print("  {:<10} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f}".format(
+              stage,
+              sum(values) / len(values) * 1000,
+              percentile(values, 95) * 1000,
+              max(values) * 1000,
+              growth))
+
+    # a refresh must complete within the sample interval to keep up
+    mean_total = sum(total) / len(total)
+    print("  {} the 1s interval ({:.0%} used)\n".format(
+          "keeps up with" if mean_total < 1 else "FALLS BEHIND",
+          mean_total))
+
+
+def get_options():
+    parser = argparse.ArgumentParser(prog='pipeline',
+                                     description='gwtop pipeline benchmark')
+    parser.add_argument('-l', '--luns', type=str, default='100,1000,10000',
+                        help='comma separated list of LUN counts')
+    parser.add_argument('-g', '--gateways', type=int, default=2,
+                        help='number of gateways')
+    parser.add_argument('-c', '--churn', type=float, default=0.3,
+                        help='fraction of LUNs with I/O in each sample')
+    parser.add_argument('-n', '--refreshes', type=int, default=20,
+                        help='number of refreshes timed')
+    parser.add_argument('-w', '--warmup', type=int, default=2,
+                        help='number of refreshes run before timing')
+    parser.add_argument('-p', '--provider', type=str, default='dm',
+                        choices=['dm', 'lio', 'combined'],
+                        help='pcp provider layout to simulate')
+    parser.add_argument('-s', '--sortkey', type=str, default='image',
+                        help='sort key')
+    parser.add_argument('-T', '--top', type=int,
+                        help='only show the top n LUNs')
+    parser.add_argument('-b', '--busy-only', action='store_true',
+                        default=False,
+                        help='show only active devices')
+    parser.add_argument('-P', '--percentiles', action='store_true',
+                        default=False,
+                        help='maintain the latency percentiles')
+    parser.add_argument('-R', '--rates', type=str, default='interval',
+                        choices=RATE_CHOICES,
+                        help='rate window of the columns shown')
+    parser.add_argument('-V', '--view', type=str, default='luns',
+                        choices=['luns', 'matrix', 'gateways'],
+                        help='text mode view to render')
+    parser.add_argument('--single', action='store_true', default=False,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    options = get_options()
+    random.seed(0)
+
+    lun_counts = [int(count) for count in options.luns.split(',')]
+
+    if options.single or len(lun_counts) == 1:
+        timings, rss_growth = run_benchmark(options, lun_counts[0])
+        report(options, lun_counts[0], timings, rss_growth)
+    else:
+        # run each LUN count in it's own process, so the memory figures
+        # aren't skewed by earlier runs
+        for count in lun_counts:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__)] +
+                                  sys.argv[1:] +
+                                  ['--single', '--luns', str(count)])
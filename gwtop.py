@@ -11,13 +11,18 @@ from ConfigParser import ConfigParser
 from threading import Event
 import threading
 
-from gwtop.collectors.pcp_provider import PCPcollector
 from gwtop.config.generic import Config
-from gwtop.config.local import get_device_info
-from gwtop.config.lio import get_gateway_info
 from gwtop.UI.textmode import TextMode
-
-import ceph_iscsi_config.settings as settings
+from gwtop.UI.jsonmode import JSONMode
+from gwtop.UI.exporter import ExporterMode
+from gwtop.UI.datamanager import smoothed_fields, percentiles_needed
+from gwtop.utils.barrier import EpochBarrier
+from gwtop.utils.devfilter import DeviceFilter
+from gwtop.utils.histogram import LatencyTracker
+from gwtop.utils.smoothing import RateSmoother, RATE_CHOICES
+from gwtop.utils.profiler import Profiler
+from gwtop.collectors.layout import layout_lookup, custom_attr
+from gwtop.utils.recording import Recorder, RecordingReader, RecordingError
 
 # Supported config file locations/names
 CFG_FILES = ['/etc/gwtop.rc',
@@ -67,7 +72,59 @@ def exception_handler(exception_type, exception, traceback,
         print "{}: {}".format(exception_type.__name__, exception)
 
 
+def get_device_map():
+    """
+    Return the devices defined to LIO on this host. The live monitoring
+    modules are imported here, since they depend on ceph_iscsi_config,
+    rtslib and rados which are not needed to replay a recording. The device
+    map is taken from the on-disk cache when possible
+    :return: (device map, configfs fingerprint, stale flag)
+    """
+
+    import ceph_iscsi_config.settings as settings
+    from gwtop.config.local import get_device_info
+    from gwtop.config.cache import get_cached_device_map
+
+    settings.init()
+    return get_cached_device_map(get_device_info)
+
+
+def setup_summary(config):
+    """
+    Establish the state the summarize function maintains across samples
+    :param config: config object (devices and sample_interval set)
+    """
+
+    config.profiler = Profiler(enabled=options.profile)
+    config.device_generation = 0
+    config.consumed_epochs = {}
+    config.lun_filter = DeviceFilter(options.device_filter, options.exclude)
+    config.latency = LatencyTracker()
+
+    # only the attributes needed for the columns shown (and the sort key)
+    # are collected
+    config.layout = layout_lookup[options.provider].configure(
+        columns=options.columns,
+        custom=options.custom_attr,
+        fields=[options.sortkey])
+
+    disk_attr = config.layout.disk_attr
+    config.lun_rates = RateSmoother(sorted(attr for attr in disk_attr
+                                           if disk_attr[attr]['sum_method'] == 'sum'),
+                                    config.sample_interval)
+    config.gateway_rates = RateSmoother(['cpu_busy', 'net_in', 'net_out'],
+                                        config.sample_interval)
+    config.rate_fields = smoothed_fields(options, config.layout,
+                                         config.lun_rates)
+    config.lun_percentiles = percentiles_needed(options, config.layout)
+
+
 def main():
+    from gwtop.collectors.pcp_provider import PCPcollector, PCPengine
+    from gwtop.config.lio import get_gateway_info, LIORefresher
+    from gwtop.config.local import get_device_info
+    from gwtop.config.cache import DeviceMapRefresher
+
     config = Config()
     config.opts = options
     config.devices = device_map
@@ -83,11 +140,29 @@ def main():
         print "Error: Unable to determine the gateway configuration"
         sys.exit(12)
 
+    # keep the client/session snapshot current
+    lio_refresher = LIORefresher(logger, config.gateway_config)
+    lio_refresher.start()
+
     config.sample_interval = options.interval
+    setup_summary(config)
+
+    if stale_devices:
+        # the LIO configuration has changed since the cache was written, so
+        # start with the cached devices while the device map is rebuilt
+        refresher = DeviceMapRefresher(logger, config, get_device_info,
+                                       device_fingerprint)
+        refresher.start()
+
     collector_threads = []
     sync_point = Event()
     sync_point.clear()
 
+    # samples are aligned across the gateways by epoch, waiting at most
+    # sync_timeout secs for a lagging gateway
+    config.barrier = EpochBarrier(timeout=options.sync_timeout,
+                                  interval=config.sample_interval)
+
     if options.debug:
         if options.gateways:
             print ("Using gateway names from the config file(s)/run time "
@@ -107,12 +182,18 @@ def main():
                                  sync_point,
                                  host=gw,
                                  interval=config.sample_interval,
-                                 pcp_type=options.provider)
+                                 pcp_type=options.provider,
+                                 devices=config.devices.keys(),
+                                 profiler=config.profiler,
+                                 layout=config.layout)
 
         # check the state of the collector
         if collector.connected:
-            collector.daemon = True
-            collector.start()
+            config.barrier.add_member(gw)
+            collector.add_listener(config.barrier.update)
+            if options.engine == 'thread':
+                collector.daemon = True
+                collector.start()
             collector_threads.append(collector)
         else:
             del collector
@@ -121,31 +202,224 @@ def main():
     # Continue as long as we have at least 1 collector connected to a pmcd
     if len(collector_threads) > 0:
 
-        sync_point.set()
+        if options.record:
+            # write every published sample to the recording file
+            recorder = Recorder(options.record, config, collector_threads)
+            for collector in collector_threads:
+                collector.add_listener(recorder.update)
+            recorder.start()
+        else:
+            recorder = None
 
-        if options.mode == 'text':
-            interface = TextMode(config, collector_threads)
-            interface.daemon = True
+        if options.engine == 'event':
+            # drive all of the collectors from a single scheduler
+            engine = PCPengine(logger,
+                               sync_point,
+                               collector_threads,
+                               interval=config.sample_interval)
+            engine.daemon = True
+            engine.start()
 
-            # link the term variable to the textmode interface
-            global term
-            term = interface
+        sync_point.set()
 
-        interface.start()
+        run_interface(config, collector_threads)
 
-        try:
-            # wait until the interface thread exits
-            while interface.isAlive():
-                time.sleep(0.2)
-        except KeyboardInterrupt:
-            # reset the terminal settings
-            interface.reset()
+        if recorder:
+            recorder.close()
     else:
         logger.critical("Unable to continue, no pmcd's are available on the"
                         " gateways to connect to. Is pmcd running on the "
                         "gateways?")
 
 
+def run_interface(config, collectors):
+    """
+    Start the UI for the collectors, and wait for it to finish
+    """
+
+    if options.mode == 'text':
+        interface = TextMode(config, collectors)
+        interface.daemon = True
+
+        # link the term variable to the textmode interface
+        global term
+        term = interface
+
+    elif options.mode == 'json':
+        interface = JSONMode(config, collectors)
+        interface.daemon = True
+
+    elif options.mode == 'exporter':
+        interface = ExporterMode(config, collectors)
+        interface.daemon = True
+
+    interface.start()
+
+    try:
+        # wait until the interface thread exits
+        while interface.isAlive():
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        # reset the terminal settings
+        interface.reset()
+
+    # stage timings are written once the display has been reset
+    config.profiler.dump(sys.stderr)
+
+
+def replay_main():
+    """
+    Drive the UI from the samples held in a recording, instead of from the
+    pmcd's on the gateways
+    """
+
+    from gwtop.collectors.replay import (ReplayCollector, Replayer,
+                                         get_replay_gateway)
+
+    config = Config()
+    config.opts = options
+    config.devices = device_map
+    config.gateway_config = get_replay_gateway(reader)
+    config.sample_interval = reader.interval
+    setup_summary(config)
+
+    # at maximum speed, a lagging gateway sample doesn't need a deadline
+    # relative to wall clock time
+    sync_timeout = options.sync_timeout if options.speed else 0.1
+    config.barrier = EpochBarrier(members=reader.gateways,
+                                  timeout=sync_timeout,
+                                  interval=reader.interval)
+
+    collectors = []
+    for gw in reader.gateways:
+        collector = ReplayCollector(logger, gw, reader.interval,
+                                    reader.provider, device_map.keys(),
+                                    layout=config.layout)
+        collector.add_listener(config.barrier.update)
+        collectors.append(collector)
+
+    replayer = Replayer(logger, reader, config, collectors,
+                        speed=options.speed)
+    replayer.daemon = True
+    replayer.start()
+
+    run_interface(config, collectors)
+
+
+def archive_main():
+    """
+    Drive the UI from pmlogger archives (one per gateway) instead of the
+    live pmcd's. The archives are read as fast as the UI consumes the
+    samples
+    """
+
+    from gwtop.collectors.pcp_provider import PCPcollector
+
+    config = Config()
+    config.opts = options
+    config.devices = device_map
+    config.sample_interval = options.interval
+    setup_summary(config)
+
+    # a lagging archive doesn't need a deadline relative to wall clock time
+    config.barrier = EpochBarrier(timeout=0.1,
+                                  interval=config.sample_interval)
+
+    sync_point = Event()
+    sync_point.clear()
+    device_lock = threading.Lock()
+    rows_seen = {}
+
+    def add_devices(metrics):
+        """
+        add any LUNs seen in an archive that aren't defined locally, replacing
+        the device map so the summarize function sees a consistent view
+        """
+        names = metrics.samples.names
+        first_row = rows_seen.get(metrics.hostname, 0)
+        if len(names) == first_row:
+            return
+        rows_seen[metrics.hostname] = len(names)
+
+        new_devices = [devname for devname in names[first_row:]
+                       if devname not in config.devices]
+        if not new_devices:
+            return
+        with device_lock:
+            devices = dict(config.devices)
+            for devname in new_devices:
+                devices.setdefault(devname, {"size": 0,
+                                             "rbd_name": '',
+                                             "lun_type": 'block'})
+            config.devices = devices
+            config.device_generation += 1
+
+    collectors = []
+    for archive in options.archive:
+        collector = PCPcollector(logger,
+                                 sync_point,
+                                 interval=config.sample_interval,
+                                 pcp_type=options.provider,
+                                 devices=config.devices.keys(),
+                                 profiler=config.profiler,
+                                 archive=archive,
+                                 start=options.start,
+                                 finish=options.finish,
+                                 layout=config.layout)
+        if not collector.connected:
+            logger.error("Error: Unable to open archive {}".format(archive))
+            continue
+
+        config.barrier.add_member(collector.hostname)
+        collector.add_listener(add_devices)
+        collector.add_listener(config.barrier.update)
+        collector.daemon = True
+        collectors.append(collector)
+
+    if not collectors:
+        logger.critical("Unable to continue, none of the archives could be "
+                        "opened")
+        sys.exit(12)
+
+    config.gateway_config = Config()
+    config.gateway_config.gateways = [collector.hostname
+                                      for collector in collectors]
+    config.gateway_config.diskmap = {}
+    config.gateway_config.client_count = 0
+    config.gateway_config.error = False
+
+    if options.record:
+        recorder = Recorder(options.record, config, collectors)
+        for collector in collectors:
+            collector.add_listener(recorder.update)
+        recorder.start()
+    else:
+        recorder = None
+
+    for collector in collectors:
+        # don't read ahead of the consumer
+        collector.add_listener(
+            lambda metrics: config.barrier.wait_released(metrics.epoch))
+        collector.start()
+
+    def end_of_archives():
+        for collector in collectors:
+            collector.join()
+        logger.debug("archive processing complete")
+        config.barrier.close()
+
+    watcher = threading.Thread(target=end_of_archives)
+    watcher.daemon = True
+    watcher.start()
+
+    sync_point.set()
+
+    run_interface(config, collectors)
+
+    if recorder:
+        recorder.close()
+
+
 def valid_filter(dev_filter="*"):
 
     try:
@@ -158,25 +432,31 @@ def valid_filter(dev_filter="*"):
 
 def get_options():
 
-    num_user_luns = sum([1 for id in device_map
-                         if device_map[id]['lun_type'] == 'user'])
-
-    default_collector = 'dm' if num_user_luns == 0 else 'lio'
-
-    sort_fields = {"dm": ['image', 'iops', 'rbd_name', 'reads', 'writes',
-                          'await', 'io_source'],
-                   "lio": ['image', 'iops', 'io_source', 'tot_read_mb',
-                           'tot_write_mb']}
-
     # establish the defaults based on any present config file(s) config section
     defaults = {}
+    custom_metrics = {}
+    config_filters = {}
     config = ConfigParser()
     dataset = config.read(CFG_FILES)
     if len(dataset) > 0:
         if config.has_section("config"):
             defaults.update(dict(config.items("config")))
-            if 'reverse' in defaults:
-                defaults['reverse'] = True if defaults['reverse'].lower() == 'true' else False
+            # the store_true options
+            for flag in ['busy_only', 'debug', 'percentiles', 'profile',
+                         'reverse', 'scroll', 'top_10']:
+                if flag in defaults:
+                    defaults[flag] = True if defaults[flag].lower() == 'true' else False
+            # filters are comma separated lists in the config file(s). They're
+            # held back from the parser defaults, since argparse would append
+            # any run time patterns to them rather than replace them
+            for filter_opt in ['device_filter', 'exclude']:
+                if filter_opt in defaults:
+                    patterns = defaults.pop(filter_opt).split(',')
+                    config_filters[filter_opt] = [pattern.strip()
+                                                  for pattern in patterns]
+            # additional LUN metrics are defined as metric.<name> = <spec>
+            for key in [key for key in defaults if key.startswith('metric.')]:
+                custom_metrics[key[len('metric.'):]] = defaults.pop(key)
         else:
             print("Config file detected, but the format is not supported. "
                   "Ensure the file has a single section [config], and "
@@ -190,9 +470,20 @@ def get_options():
     # cfg file(s)
     parser = argparse.ArgumentParser(prog='gwtop',
                                      description='Show iSCSI gateway performance metrics')
+    parser.add_argument('-a', '--archive', type=str, action='append',
+                        metavar='PATH',
+                        help='read the samples from pmlogger archive(s), '
+                             'one per gateway - may be repeated or comma '
+                             'separated')
     parser.add_argument('-b', '--busy-only', action='store_true',
                         default=False,
                         help='show only active devices (iops > 0)')
+    parser.add_argument('--ceph-interval', type=int, metavar='SECS',
+                        help='interval in seconds between ceph health '
+                             'checks (default 30)')
+    parser.add_argument('--columns', type=str,
+                        help='comma separated list of the LUN columns to '
+                             'show (see man page for the names)')
     parser.add_argument('-c', '--config-object', type=str,
                         help='pool and object name holding the gateway config '
                              'object (pool/object_name)')
@@ -200,9 +491,17 @@ def get_options():
                         default=False,
                         help='run with additional debug')
     parser.add_argument('-d', '--device-filter', type=str,
-                        default='.*',
-                        help='device name filter (default is .* i.e. '
-                             'everything!)')
+                        action='append',
+                        help='device name filter - may be repeated (default '
+                             'is .* i.e. everything!)')
+    parser.add_argument('-e', '--engine', type=str,
+                        choices=['thread', 'event'],
+                        help='collection engine - a thread per gateway, '
+                             'or a single event driven scheduler for all '
+                             'gateways')
+    parser.add_argument('--finish', type=str, metavar='TIME',
+                        help='end of the time window read from the '
+                             'archive(s), in pcp time format')
     parser.add_argument('-g', '--gateways', type=str,
                         help='comma separated iscsi gateway server names')
     parser.add_argument('-i', '--interval', type=int,
@@ -212,22 +511,73 @@ def get_options():
                         default=9999,
                         help='sepcifiy the number of devices to show per '
                              'sample iteration')
+    parser.add_argument('-x', '--exclude', type=str,
+                        action='append',
+                        help='exclude devices matching this regex - may be '
+                             'repeated')
+    parser.add_argument('--listen', type=str, metavar='ADDR:PORT',
+                        help='address and port the exporter mode serves '
+                             'metrics on (default is 0.0.0.0:9287)')
     parser.add_argument('-m', '--mode', type=str,
-                        choices=(['text']),
+                        choices=(['text', 'json', 'exporter']),
                         help='output mode')
     parser.add_argument('-p', '--provider', type=str,
-                        choices=['dm', 'lio'],
-                        default=default_collector,
-                        help='pcp provider type lio or dm')
+                        choices=['dm', 'lio', 'combined'],
+                        help='pcp provider type lio, dm or combined (both '
+                             'in the same fetch)')
+    parser.add_argument('--percentiles', action='store_true',
+                        default=False,
+                        help='show the p50/p95/p99 await instead of the '
+                             'read/write await (dm provider only)')
+    parser.add_argument('--profile', action='store_true',
+                        default=False,
+                        help='time each stage of the refresh cycle, showing '
+                             'the timings in a status line (text mode) and '
+                             'on exit')
+    parser.add_argument('--rates', type=str,
+                        choices=RATE_CHOICES,
+                        help='show rates averaged over a window (1m, 5m, '
+                             '15m) or as an ewma, instead of the last '
+                             'interval (default)')
+    parser.add_argument('--record', type=str, metavar='FILE',
+                        help='record every sample to the given file')
+    parser.add_argument('--replay', type=str, metavar='FILE',
+                        help='display the samples from a recording, instead '
+                             'of connecting to the gateways')
+    parser.add_argument('--scroll', action='store_true',
+                        default=False,
+                        help='text mode prints each refresh in full below '
+                             'the last, instead of redrawing the screen')
     parser.add_argument('-s', '--sortkey', type=str,
                         default='image',
                         help='sort key field name (dependent upon provider - '
                              'see man page for more info)')
+    parser.add_argument('--speed', type=float,
+                        default=1.0,
+                        help='replay speed multiplier, 0 replays as fast as '
+                             'the samples can be displayed (default is 1)')
+    parser.add_argument('--start', type=str, metavar='TIME',
+                        help='start of the time window read from the '
+                             'archive(s), in pcp time format')
+    parser.add_argument('--sync-timeout', type=float,
+                        help='secs to wait for a lagging gateway before '
+                             'showing a partial sample (default is the '
+                             'interval)')
     parser.add_argument('-t', '--top-10', action='store_true',
                         default=False,
-                        help='show the top 10 LUNs with highest iops')
+                        help='show the top 10 LUNs with highest iops '
+                             '(same as --top 10)')
+    parser.add_argument('-T', '--top', type=int, metavar='N',
+                        help='show the top N LUNs by the sort key (iops by '
+                             'default), highest first')
     parser.add_argument('-r', '--reverse', action='store_true', default=False,
                         help='use reverse sort when displaying the stats')
+    parser.add_argument('--view', type=str,
+                        choices=['luns', 'matrix', 'gateways'],
+                        help='initial text mode view - a row per LUN '
+                             '(default), a gateway x LUN matrix, or the '
+                             'totals of each gateway. The v key cycles '
+                             'through the views')
     parser.add_argument('-v', '--version',
                         action='version',
                         version='%(prog)s 2.1')
@@ -245,9 +595,155 @@ def get_options():
         opts.interval = 1
     if not opts.mode:
         opts.mode = 'text'
+    if opts.top is not None and opts.top < 1:
+        print("Invalid --top value, must be 1 or more")
+        sys.exit(16)
+
+    if not opts.listen:
+        opts.listen = '0.0.0.0:9287'
+    if not opts.engine:
+        opts.engine = 'thread'
+    if not opts.sync_timeout:
+        opts.sync_timeout = float(opts.interval)
+    if not opts.ceph_interval:
+        opts.ceph_interval = 30
+    if not opts.rates:
+        opts.rates = 'interval'
+    if not opts.view:
+        opts.view = 'luns'
     if not opts.config_object:
         opts.config_object = 'rbd/gateway.conf'
 
+    if not re.match(r'^[^:]*:\d+$', opts.listen):
+        print("Invalid listen address, must be in the form ADDR:PORT")
+        sys.exit(16)
+
+    if opts.archive:
+        if opts.replay:
+            print("Only one of --archive and --replay may be used")
+            sys.exit(16)
+        opts.archive = [path.strip() for archive in opts.archive
+                        for path in archive.split(',') if path.strip()]
+    elif opts.start or opts.finish:
+        print("--start and --finish are only valid with --archive")
+        sys.exit(16)
+
+    if opts.record and os.path.exists(opts.record):
+        print("{} already exists, choose a new file to record "
+              "to".format(opts.record))
+        sys.exit(16)
+
+    if opts.columns:
+        opts.columns = [column.strip() for column in opts.columns.split(',')
+                        if column.strip()]
+    if not opts.columns:
+        opts.columns = None
+
+    opts.custom_attr = {}
+    for name, spec in custom_metrics.items():
+        try:
+            opts.custom_attr[name] = custom_attr(name, spec)
+        except ValueError as err:
+            print("Invalid metric.{} in the config file(s) : {}".format(name,
+                                                                      err))
+            sys.exit(16)
+
+    # run time filters replace those from the config file(s)
+    if opts.device_filter is None:
+        opts.device_filter = config_filters.get('device_filter')
+    if opts.exclude is None:
+        opts.exclude = config_filters.get('exclude')
+
+    if not opts.device_filter:
+        opts.device_filter = ['.*']
+    if not opts.exclude:
+        opts.exclude = []
+
+    # Ensure any device filter name is valid
+    if not all(valid_filter(pattern)
+               for pattern in opts.device_filter + opts.exclude):
+        print("Invalid device filter specification, must be python regex "
+              "compatible")
+        sys.exit(16)
+
+    return opts
+
+
+def check_recorded_metrics(opts, recorded, explicit_columns):
+    """
+    Validate the columns and sort key of a replay against the metrics held
+    in the recording. The default columns are reduced to the ones that were
+    recorded, but columns that were asked for must have been recorded
+    :param opts: runtime options
+    :param recorded: metric names held in the recording
+    :param explicit_columns: True if the columns were given by --columns or
+    the config file(s)
+    """
+
+    layout = layout_lookup[opts.provider]
+
+    def unrecorded(columns, fields=None):
+        needed = layout.configure(columns=columns,
+                                  custom=opts.custom_attr,
+                                  fields=fields).disk_attr
+        return sorted(set(needed) - set(recorded))
+
+    if not explicit_columns:
+        opts.columns = [column for column in opts.columns
+                        if not unrecorded([column])]
+
+    missing = unrecorded(opts.columns, [opts.sortkey])
+    if missing:
+        print("The recording does not hold the metric(s) {} needed for the "
+              "columns and sort key requested".format(','.join(missing)))
+        print("The recorded metrics are {}".format(','.join(recorded)))
+        sys.exit(12)
+
+
+def check_provider(opts, devices, recorded_provider=None):
+    """
+    Establish the pcp provider, and validate the options that depend upon
+    it
+    :param opts: runtime options
+    :param devices: device map
+    :param recorded_provider: provider used by a recording being replayed
+    """
+
+    sort_fields = {"dm": ['image', 'iops', 'rbd_name', 'reads', 'writes',
+                          'await', 'io_source', 'client', 'p50_await',
+                          'p95_await', 'p99_await'],
+                   "lio": ['image', 'iops', 'io_source', 'tot_read_mb',
+                           'tot_write_mb', 'client']}
+
+    # the combined provider shows the dm fields, with the lio LUNs merged in
+    sort_fields['combined'] = list(sort_fields['dm'])
+
+    # metrics defined in the config file(s), and the smoothed rates of the
+    # summed metrics e.g. iops_5m
+    for provider in sort_fields:
+        disk_attr = dict(layout_lookup[provider].disk_attr)
+        for name, (attr, _column) in opts.custom_attr.items():
+            disk_attr[name] = attr
+            sort_fields[provider].append(name)
+        sort_fields[provider].extend('{}_{}'.format(attr, rate)
+                                     for attr in sorted(disk_attr)
+                                     if disk_attr[attr]['sum_method'] == 'sum'
+                                     for rate in RATE_CHOICES[1:])
+
+    if recorded_provider:
+        opts.provider = recorded_provider
+    elif not opts.provider:
+        num_user_luns = sum([1 for id in devices
+                             if devices[id]['lun_type'] == 'user'])
+
+        # a mix of user (TCMU) and krbd backed LUNs needs both providers
+        if num_user_luns == 0:
+            opts.provider = 'dm'
+        elif num_user_luns == len(devices):
+            opts.provider = 'lio'
+        else:
+            opts.provider = 'combined'
+
     # if the sort key is not the default, validate it against the
     # specific pcp providers sort fields list
     if opts.sortkey is not 'image':
@@ -257,29 +753,71 @@ def get_options():
                                                       sort_fields[opts.provider]))
             sys.exit(12)
 
-    # Ensure any device filter name is valid
-    if not valid_filter(opts.device_filter):
-        print("Invalid device filter specification, must be python regex "
-              "compatible")
-        sys.exit(16)
+    # the combined provider extracts each metric from the config file(s)
+    # with the provider sharing it's instances, so it must be one of theirs
+    if opts.provider == 'combined':
+        prefixes = tuple(layout_lookup[provider].metric_prefix
+                         for provider in ['dm', 'lio'])
+        unmatched = sorted(name for name, (attr, _column)
+                           in opts.custom_attr.items()
+                           if not attr['metrics'][0].startswith(prefixes))
+        if unmatched:
+            print("Invalid metric(s) {} for the combined pcp provider, the "
+                  "pcp metric must be one of {}*".format(','.join(unmatched),
+                                                         '*,'.join(prefixes)))
+            sys.exit(12)
 
-    if opts.top_10:
-        opts.sortkey = 'iops'
-        opts.limit = 10
-        opts.reverse = True
+    # validate the columns to show, or establish the default columns
+    layout = layout_lookup[opts.provider]
+    if opts.columns:
+        columns = layout.column_names() + sorted(opts.custom_attr)
+        unknown = [column for column in opts.columns if column not in columns]
+        if unknown:
+            print("Invalid column(s) {} for the {} pcp "
+                  "provider".format(','.join(unknown), opts.provider))
+            print("For {}, the columns are {}".format(opts.provider, columns))
+            sys.exit(12)
+    else:
+        opts.columns = (layout.default_columns(opts.percentiles) +
+                        sorted(opts.custom_attr))
 
-    return opts
+    if opts.top_10 and not opts.top:
+        opts.top = 10
+
+    if opts.top:
+        if opts.sortkey == 'image':
+            opts.sortkey = 'iops'
+        opts.limit = opts.top
+        opts.reverse = True
 
 
 if __name__ == '__main__':
 
-    settings.init()
+    options = get_options()
 
     # establish the device map early so we can determine which collector to
     # use by default
-    device_map = get_device_info()
-
-    options = get_options()
+    if options.replay:
+        try:
+            reader = RecordingReader(options.replay)
+        except (IOError, RecordingError) as err:
+            print("Unable to replay {} : {}".format(options.replay, err))
+            sys.exit(16)
+        device_map = reader.devices
+        explicit_columns = options.columns is not None
+        check_provider(options, device_map, reader.provider)
+        check_recorded_metrics(options, reader.metrics, explicit_columns)
+    elif options.archive:
+        # the LUN details are taken from this host's LIO config when it's
+        # available, otherwise the LUNs are named from the archives
+        try:
+            device_map = get_device_map()[0]
+        except (ImportError, IOError, OSError):
+            device_map = {}
+        check_provider(options, device_map)
+    else:
+        device_map, device_fingerprint, stale_devices = get_device_map()
+        check_provider(options, device_map)
 
     term = None
 
@@ -304,4 +842,9 @@ if __name__ == '__main__':
     ch.setFormatter(fmt)
     logger.addHandler(ch)
 
-    main()
+    if options.replay:
+        replay_main()
+    elif options.archive:
+        archive_main()
+    else:
+        main()
@@ -1,10 +1,142 @@
 #!/usr/bin/env python
 __author__ = 'Paul Cuzner'
 
-from time import sleep
+from time import localtime, strftime
 
 from gwtop.config.generic import DiskSummary, HostSummary
+from gwtop.collectors.layout import rate_field, PERCENTILE_FIELDS
+from gwtop.utils.profiler import monotonic
 from socket import gethostname
+from operator import itemgetter
+
+
+def lun_column(samples, attr, slot, devices, aligned):
+    """
+    Return the values of a metric from a slot in a collector's sample ring
+    in the given device sequence
+    :param samples: SampleRing from a collector
+    :param attr: metric name
+    :param slot: sample slot to use
+    :param devices: list of device names defining the LUN sequence
+    :param aligned: True if the ring's rows start with the devices list
+    :return: array/list of values, one per device
+    """
+
+    num_devices = len(devices)
+    column = samples.column(attr, slot=slot, rows=len(samples))
+
+    if aligned:
+        # rows were seeded from the same device list, so take them as is
+        return column[:num_devices]
+
+    index = samples.index
+    return [column[index[dev]] if dev in index else 0.0
+            for dev in devices]
+
+
+def pick(values, indices):
+    """
+    Return the values at the given indices
+    :param values: list/array
+    :param indices: list of indices
+    :return: list
+    """
+
+    if len(indices) == len(values):
+        return list(values)
+    if not indices:
+        return []
+    if len(indices) == 1:
+        return [values[indices[0]]]
+
+    return list(itemgetter(*indices)(values))
+
+
+def reduce_columns(method, columns, num_luns):
+    """
+    Reduce a gateways x LUNs matrix to a single value per LUN
+    :param method: reduction function (sum or max)
+    :param columns: list of per gateway columns
+    :param num_luns: number of LUNs (used when there are no columns)
+    :return: list of values, one per LUN
+    """
+
+    if not columns:
+        return [0.0] * num_luns
+
+    if len(columns) == 1:
+        return list(columns[0])
+
+    return map(method, zip(*columns))
+
+
+def gateway_totals(disk_attr, matrix, gateways):
+    """
+    Roll up each gateway's LUN values
+    :param disk_attr: disk attributes of the collector
+    :param matrix: dict of attr -> list of per gateway columns
+    :param gateways: gateway names, in the matrix column sequence
+    :return: dict of gateway -> dict of tot_<attr>/max_<attr> values and
+    the number of active LUNs
+    """
+
+    totals = dict((gateway, {}) for gateway in gateways)
+    for attr_name in disk_attr:
+        sum_method = disk_attr[attr_name]['sum_method']
+        field_name = '{}_{}'.format('tot' if sum_method == 'sum'
+                                    else sum_method, attr_name)
+        method = sum if sum_method == 'sum' else max
+        for gateway, column in zip(gateways, matrix[attr_name]):
+            totals[gateway][field_name] = method(column) if len(column) \
+                else 0.0
+
+    for gateway, column in zip(gateways, matrix['iops']):
+        totals[gateway]['active_luns'] = len(column) - column.count(0.0)
+
+    return totals
+
+
+def smoothed_fields(opts, layout, lun_rates):
+    """
+    Establish the smoothed rates summarize adds to each LUN. json output
+    holds every smoothed rate, otherwise only the rates shown (the --rates
+    window of the summed columns) or sorted on are calculated
+    :param opts: runtime options
+    :param layout: layout in use
+    :param lun_rates: RateSmoother of the LUNs
+    :return: list of smoothed field names, or None for every field
+    """
+
+    if opts.mode == 'json':
+        return None
+
+    fields = [opts.sortkey]
+    if opts.mode == 'text' and opts.rates != 'interval':
+        for column in layout.selected_columns():
+            attr = column.get('attr')
+            if attr and layout.disk_attr[attr]['sum_method'] == 'sum':
+                fields.append(rate_field(attr, opts.rates))
+
+    return sorted(set(field for field in fields
+                      if field in lun_rates.field_map))
+
+
+def percentiles_needed(opts, layout):
+    """
+    Establish whether summarize derives the latency percentiles of each LUN.
+    They're held in json output, otherwise they're only needed when they're
+    shown (--percentiles, or a p50-p99 column) or sorted on
+    :param opts: runtime options
+    :param layout: layout in use
+    :return: True if the percentiles are needed
+    """
+
+    if opts.mode == 'json' or opts.percentiles:
+        return True
+
+    fields = [column.get('field') for column in layout.selected_columns()]
+    return any(field in PERCENTILE_FIELDS
+               for field in fields + [opts.sortkey])
 
 
 def summarize(config, pcp_threads):
@@ -18,98 +150,159 @@ def summarize(config, pcp_threads):
 
     dev_stats = {}
     gw_stats = HostSummary()
-    first_pass = True
-
-    # Attempt to sync all the threads by timestamp, before summarising
-    in_sync = False
-    msg_issued = False
-
-    while not in_sync:
-        timestamps = set()        
-        for collector in pcp_threads:
-            timestamps.add(collector.metrics.timestamp)
-        if len(timestamps) != 1:
-            # not in sync at the moment
-            sleep(0.1)
-            if not msg_issued:
-                collector.logger.debug("\nWaiting for collectors to synchronise")
-                msg_issued = True
-        else:
-            in_sync = True
+
+    # wait for the collectors to reach the next epoch. If the deadline
+    # expires, the gateways that are lagging are left out of the summary
+    profiler = config.profiler
+    start = monotonic()
+    epoch, ready = config.barrier.wait()
+    profiler.record('sync', monotonic() - start)
+    start = monotonic()
 
     this_host = gethostname().split('.')[0]
 
-    # device will be of the form - <pool>.<image_name>
-    for dev in config.devices:
-
-        summary = DiskSummary()
-        summary.disk_size = config.devices[dev]['size']
-        summary.rbd_name = config.devices[dev]['rbd_name']
-        summary.io_source = ''
-
-        # process each collector thread's data for this device
-        for collector in pcp_threads:
-
-            if dev in collector.metrics.disk_stats:
-
-                disk = collector.metrics.disk_stats[dev]
-
-                for attr in collector.disk_attr.keys():
-
-                    collector_obs = getattr(disk, attr)
-                    current = getattr(summary, attr)
-                    current.append(collector_obs)
-                    setattr(summary, attr, current)
-
-                if disk.iops > 0:
-                    if collector.hostname == this_host:
-                        # I/O is serviced (T)his gateway
-                        summary.io_source = 'T'
-                    else:
-                        # I/O is serviced by (O)ther gateway
-                        summary.io_source = 'O'
-
-            # some metrics we only gather during the first cycle through the
-            # collector threads
-            if first_pass:
-                gw_stats.cpu_busy.append(collector.metrics.cpu_busy_pct)
-                gw_stats.net_in.append(collector.metrics.nic_bytes['in'])
-                gw_stats.net_out.append(collector.metrics.nic_bytes['out'])
-
-        first_pass = False
-
-        # roll up the summary data relevant to the specific collectors
-        # disk attributes
-        for attr_name in collector.disk_attr.keys():
-            attr_defn = collector.disk_attr[attr_name]
-            if attr_defn['sum_method'] == 'sum':
-                field_name = 'tot_{}'.format(attr_name)
-                setattr(summary, field_name, sum(getattr(summary, attr_name)))
-            elif attr_defn['sum_method'] == 'max':
-                field_name = 'max_{}'.format(attr_name)
-                current_value = getattr(summary, attr_name)
-                if len(current_value) > 0:
-                    setattr(summary, field_name, max(current_value))
-                else:
-                    setattr(summary, field_name, 0)
-
-        summary.collector = collector.collector
+    # device will be of the form - <pool>.<image_name>. The filter caches
+    # the sorted device list and the indices of the LUNs that pass the
+    # device filter. Take a single reference to the
+    # device map (it may be replaced by a background refresh)
+    generation = config.device_generation
+    device_info = config.devices
+    devices, eligible = config.lun_filter.update(device_info, generation)
+    collector = pcp_threads[0]
+    disk_attr = collector.disk_attr
+
+    # lay each collector's sample for the epoch out as a gateways x LUNs
+    # matrix per metric, then roll up each metric in a single reduction
+    matrix = dict((attr, []) for attr in disk_attr)
+    local_iops = None
+    sample_time = None
+    consumed_epochs = config.consumed_epochs
+
+    # latency percentiles are only available from providers with an await,
+    # and the histograms are only maintained when the percentiles are used
+    latency = config.latency if (config.lun_percentiles and
+                                 'await' in disk_attr) else None
+    for collector in pcp_threads:
+        samples = collector.metrics.samples
+
+        # a sample is only summarised once, so a gateway without a sample
+        # newer than the last one consumed is missing from this epoch
+        slot = None
+        if collector.hostname in ready:
+            slot = samples.slot_for_epoch(
+                epoch, tolerance=1,
+                after=consumed_epochs.get(collector.hostname))
 
+        if slot is None:
+            gw_stats.missing.append(collector.hostname)
+        else:
+            consumed_epochs[collector.hostname] = samples.epochs[slot]
+            sample_time = samples.timestamps[slot]
+            gw_stats.gateways.append(collector.hostname)
+            aligned = samples.names[:len(devices)] == devices
+            for attr in disk_attr:
+                matrix[attr].append(lun_column(samples, attr, slot, devices,
+                                               aligned))
+            if collector.hostname == this_host:
+                local_iops = matrix['iops'][-1]
+
+            if latency is not None:
+                # feed the gateway's latency histograms, weighted by the
+                # number of I/Os in the interval
+                ios = [iops * config.sample_interval
+                       for iops in matrix['iops'][-1]]
+                latency.add_sample(collector.hostname, devices,
+                                   matrix['await'][-1], ios)
+
+        gw_stats.cpu_busy.append(collector.metrics.cpu_busy_pct)
+        gw_stats.net_in.append(collector.metrics.nic_bytes['in'])
+        gw_stats.net_out.append(collector.metrics.nic_bytes['out'])
+
+    rollup = {}
+    for attr_name in disk_attr:
+        attr_defn = disk_attr[attr_name]
+        if attr_defn['sum_method'] == 'sum':
+            field_name = 'tot_{}'.format(attr_name)
+            rollup[field_name] = reduce_columns(sum, matrix[attr_name],
+                                                len(devices))
+        elif attr_defn['sum_method'] == 'max':
+            field_name = 'max_{}'.format(attr_name)
+            rollup[field_name] = reduce_columns(max, matrix[attr_name],
+                                                len(devices))
+
+    # keep the per gateway values, and each gateway's totals, for the
+    # gateway views
+    gw_stats.lun_matrix = matrix
+    gw_stats.lun_index = config.lun_filter.index
+    gw_stats.gateway_totals = gateway_totals(disk_attr, matrix,
+                                             gw_stats.gateways)
+
+    # I/O serviced by (T)his gateway takes precedence over I/O serviced
+    # by an (O)ther gateway
+    tot_iops = rollup['tot_iops']
+    if local_iops is None:
+        io_source = ['O' if iops > 0 else '' for iops in tot_iops]
+    else:
+        io_source = ['T' if local > 0 else ('O' if iops > 0 else '')
+                     for local, iops in zip(local_iops, tot_iops)]
+
+    # maintain the smoothed rates of every LUN and gateway
+    lun_rates = config.lun_rates
+    gateway_rates = config.gateway_rates
+    hostnames = [collector.hostname for collector in pcp_threads]
+    if sample_time is not None:
+        lun_rates.update(devices,
+                         dict((metric, rollup['tot_{}'.format(metric)])
+                              for metric in lun_rates.metrics))
+        gateway_rates.update(hostnames, {'cpu_busy': gw_stats.cpu_busy,
+                                         'net_in': gw_stats.net_in,
+                                         'net_out': gw_stats.net_out})
+    gw_stats.rates = dict((hostname, gateway_rates.fields(hostname))
+                          for hostname in hostnames)
+
+    # per LUN summary objects are only built for the eligible LUNs, the
+    # gateway totals cover every LUN. The smoothed rates are only derived
+    # for the fields in use
+    eligible_devices = pick(devices, eligible)
+    field_columns = dict((field_name, pick(values, eligible))
+                         for field_name, values in rollup.items())
+    field_columns.update(lun_rates.columns(eligible_devices,
+                                           config.rate_fields))
+    field_names = list(field_columns)
+    field_values = zip(*[field_columns[field_name]
+                         for field_name in field_names])
+
+    for dev, values, source in zip(eligible_devices, field_values,
+                                   pick(io_source, eligible)):
+        dev_info = device_info[dev]
+        summary = DiskSummary(disk_size=dev_info['size'],
+                              rbd_name=dev_info['rbd_name'],
+                              io_source=source,
+                              collector=collector.collector)
+        summary.__dict__.update(zip(field_names, values))
+        if latency is not None:
+            (summary.p50_await,
+             summary.p95_await,
+             summary.p99_await) = latency.percentiles(dev)
         dev_stats[dev] = summary
-        gw_stats.total_capacity += int(summary.disk_size)
-        gw_stats.total_iops += int(summary.tot_iops)
+
+    gw_stats.total_capacity = sum([int(device_info[dev]['size'])
+                                   for dev in devices])
+    gw_stats.total_iops = sum([int(iops) for iops in tot_iops])
 
     gw_stats.total_net_in = sum(gw_stats.net_in)
     gw_stats.total_net_out = sum(gw_stats.net_out)
     gw_stats.min_cpu = min(gw_stats.cpu_busy)
     gw_stats.max_cpu = max(gw_stats.cpu_busy)
 
-
-
-    dt_parts = str(list(timestamps)[0]).split()
-    if dt_parts[0] == 'None':
+    if sample_time is None:
         gw_stats.timestamp = 'NO DATA'
     else:
-        gw_stats.timestamp = dt_parts[3]
+        gw_stats.timestamp = strftime('%H:%M:%S', localtime(sample_time))
+
+    gw_stats.sample_time = sample_time
+    gw_stats.partial = len(gw_stats.missing) > 0
+
+    profiler.record('summarize', monotonic() - start)
 
     return gw_stats, dev_stats
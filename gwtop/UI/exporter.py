@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import threading
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from gwtop.UI.datamanager import summarize
+
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+TEXT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# metric family of each disk attribute, in base units - attribute ->
+# (family name, unit, multiplier to the base unit, help text). Attributes
+# without an entry (e.g. metrics defined in the config file) are exported
+# as gwtop_lun_<attribute>, unscaled
+LUN_FAMILIES = {
+    'iops': ('gwtop_lun_operations_per_second', 'operations_per_second', 1,
+             'I/O operations per second'),
+    'reads': ('gwtop_lun_read_operations_per_second', 'operations_per_second',
+              1, 'Read operations per second'),
+    'writes': ('gwtop_lun_write_operations_per_second',
+               'operations_per_second', 1, 'Write operations per second'),
+    'readkb': ('gwtop_lun_read_bytes_per_second', 'bytes_per_second', 1024,
+               'Bytes read per second'),
+    'writekb': ('gwtop_lun_write_bytes_per_second', 'bytes_per_second', 1024,
+                'Bytes written per second'),
+    'read_mb': ('gwtop_lun_read_bytes_per_second', 'bytes_per_second',
+                1024 * 1024, 'Bytes read per second'),
+    'write_mb': ('gwtop_lun_write_bytes_per_second', 'bytes_per_second',
+                 1024 * 1024, 'Bytes written per second'),
+    'await': ('gwtop_lun_await_seconds', 'seconds', 0.001,
+              'Average I/O service time'),
+    'r_await': ('gwtop_lun_read_await_seconds', 'seconds', 0.001,
+                'Average read service time'),
+    'w_await': ('gwtop_lun_write_await_seconds', 'seconds', 0.001,
+                'Average write service time')
+}
+
+
+def escape_label(value):
+    """ escape a label value for the exposition format """
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serve the exposition rendered by the ExporterMode thread. Scrapes never
+    trigger a fetch from pmcd, they just receive the cached bytes
+    """
+
+    def do_GET(self):
+        exporter = self.server.exporter
+
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+
+        if 'application/openmetrics-text' in self.headers.get('Accept', ''):
+            content_type = OPENMETRICS_TYPE
+            payload = exporter.openmetrics_payload
+        else:
+            content_type = TEXT_TYPE
+            payload = exporter.text_payload
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        # keep scrapes out of the console
+        pass
+
+
+class ExporterMode(threading.Thread):
+    """
+    Class that provides the exporter mode of the tool. The latest aggregated
+    metrics are rendered in the OpenMetrics text format once per sample, and
+    served over http to any number of scrapers. An object of this class runs
+    as a thread
+    """
+
+    def __init__(self, config, pcp_threads):
+        threading.Thread.__init__(self)
+        self.config = config
+        self.pcp_collectors = pcp_threads
+
+        host, port = config.opts.listen.rsplit(':', 1)
+        self.address = (host, int(port))
+
+        self.text_payload = ''
+        self.openmetrics_payload = '# EOF\n'
+
+    def render(self, gw_stats, disk_summary):
+        """
+        Render the aggregated stats in the exposition format
+        :param gw_stats: gateway metrics (cpu, network)
+        :param disk_summary: disk summary information (dict) indexed by
+        pool/rbd_image
+        :return: exposition (str), without the EOF marker
+        """
+
+        lines = []
+
+        def family(name, help_text, samples, metric_type='gauge', unit=None):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            if unit:
+                lines.append('# UNIT {} {}'.format(name, unit))
+            for labels, value in samples:
+                if labels:
+                    label_str = ','.join('{}="{}"'.format(key,
+                                                         escape_label(labels[key]))
+                                         for key in sorted(labels))
+                    lines.append('{}{{{}}} {}'.format(name, label_str,
+                                                      repr(float(value))))
+                else:
+                    lines.append('{} {}'.format(name, repr(float(value))))
+
+        gateway_config = self.config.gateway_config
+
+        family('gwtop_sample_timestamp_seconds',
+               'Time of the sample being reported',
+               [({}, gw_stats.sample_time or 0)],
+               unit='seconds')
+        family('gwtop_sample_partial',
+               '1 if one or more gateways missed the sample',
+               [({}, 1 if gw_stats.partial else 0)])
+        family('gwtop_gateways',
+               'Number of gateways defined',
+               [({}, len(gateway_config.gateways))])
+        family('gwtop_gateway_cpu_busy_percent',
+               'CPU utilisation of each gateway',
+               [({'gateway': collector.hostname}, cpu)
+                for collector, cpu in zip(self.pcp_collectors,
+                                          gw_stats.cpu_busy)],
+               unit='percent')
+        family('gwtop_gateway_network_receive_bytes_per_second',
+               'Network bytes received by each gateway',
+               [({'gateway': collector.hostname}, net_in)
+                for collector, net_in in zip(self.pcp_collectors,
+                                             gw_stats.net_in)],
+               unit='bytes_per_second')
+        family('gwtop_gateway_network_transmit_bytes_per_second',
+               'Network bytes sent by each gateway',
+               [({'gateway': collector.hostname}, net_out)
+                for collector, net_out in zip(self.pcp_collectors,
+                                              gw_stats.net_out)],
+               unit='bytes_per_second')
+        family('gwtop_capacity_bytes',
+               'Total capacity of the LUNs',
+               [({}, gw_stats.total_capacity)],
+               unit='bytes')
+        family('gwtop_operations_per_second',
+               'Total I/O operations per second across all LUNs and gateways',
+               [({}, gw_stats.total_iops)],
+               unit='operations_per_second')
+        family('gwtop_clients',
+               'Number of clients defined',
+               [({}, gateway_config.client_count)])
+
+        devices = sorted(disk_summary)
+        lun_labels = dict((devname, {'image': devname})
+                          for devname in devices)
+
+        family('gwtop_lun_size_bytes',
+               'Size of the LUN',
+               [(lun_labels[devname], disk_summary[devname].disk_size)
+                for devname in devices],
+               unit='bytes')
+
+        disk_attr = self.pcp_collectors[0].disk_attr
+        for attr_name in sorted(disk_attr):
+            sum_method = disk_attr[attr_name]['sum_method']
+            field_name = '{}_{}'.format('tot' if sum_method == 'sum'
+                                        else sum_method, attr_name)
+            name, unit, scale, help_text = LUN_FAMILIES.get(
+                attr_name, ('gwtop_lun_{}'.format(attr_name), None, 1,
+                            attr_name))
+            family(name,
+                   '{} ({} across the gateways)'.format(help_text,
+                                                        sum_method),
+                   [(lun_labels[devname],
+                     getattr(disk_summary[devname], field_name) * scale)
+                    for devname in devices],
+                   unit=unit)
+
+        lines.append('')
+        return '\n'.join(lines)
+
+    def reset(self):
+        """ no terminal state to restore in exporter mode """
+        pass
+
+    def run(self):
+        """
+        Main method for the thread. Start the http server, then re-render the
+        exposition each time the collectors complete a sample
+        """
+
+        server = MetricsServer(self.address, MetricsHandler)
+        server.exporter = self
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        while True:
+            gw_stats, disk_summary = summarize(self.config,
+                                               self.pcp_collectors)
+            if gw_stats.timestamp == 'NO DATA':
+                if self.config.barrier.closed:
+                    break
+                continue
+
+            body = self.render(gw_stats, disk_summary)
+
+            # swap in the new payloads - handlers always see a complete
+            # exposition
+            self.text_payload = body
+            self.openmetrics_payload = body + '# EOF\n'
+
+        server.shutdown()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import errno
+import json
+import sys
+import threading
+
+from gwtop.UI.datamanager import summarize
+
+
+class JSONMode(threading.Thread):
+    """
+    Class that provides the json output mode of the tool. Each refresh is
+    written to stdout as a single line of json (NDJSON), for consumption by
+    other tools. An object of this class runs as a thread
+    """
+
+    def __init__(self, config, pcp_threads, output=sys.stdout):
+        threading.Thread.__init__(self)
+        self.config = config
+        self.pcp_collectors = pcp_threads
+        self.output = output
+
+    def build_record(self, gw_stats, disk_summary):
+        """
+        Convert the aggregated stats to a dict ready for json serialisation
+        :param gw_stats: gateway metrics (cpu, network)
+        :param disk_summary: disk summary information (dict) indexed by
+        pool/rbd_image
+        :return: dict
+        """
+
+        gateway_config = self.config.gateway_config
+        opts = self.config.opts
+
+        luns = []
+        for devname in sorted(disk_summary):
+            lun = disk_summary[devname]
+
+            if opts.busy_only and not lun.tot_iops > 0:
+                continue
+
+            lun_data = dict((field, value)
+                            for field, value in lun.__dict__.items()
+                            if field != 'collector')
+            lun_data['name'] = devname
+            lun_data['clients'] = gateway_config.diskmap.get(devname, [])
+            luns.append(lun_data)
+
+        return {"time": gw_stats.sample_time,
+                "timestamp": gw_stats.timestamp,
+                "partial": gw_stats.partial,
+                "missing": gw_stats.missing,
+                "gateways": len(gw_stats.cpu_busy),
+                "gateways_defined": len(gateway_config.gateways),
+                "min_cpu": gw_stats.min_cpu,
+                "max_cpu": gw_stats.max_cpu,
+                "net_in": gw_stats.total_net_in,
+                "net_out": gw_stats.total_net_out,
+                "gateway_rates": gw_stats.rates,
+                "gateway_totals": gw_stats.gateway_totals,
+                "capacity": gw_stats.total_capacity,
+                "iops": gw_stats.total_iops,
+                "clients": gateway_config.client_count,
+                "luns": luns}
+
+    def reset(self):
+        """ no terminal state to restore in json mode """
+        pass
+
+    def run(self):
+        """
+        Main method for the thread. Write a record each time the collectors
+        complete a sample
+        """
+
+        while True:
+            gw_stats, disk_summary = summarize(self.config,
+                                               self.pcp_collectors)
+            if gw_stats.timestamp == 'NO DATA':
+                if self.config.barrier.closed:
+                    break
+                continue
+
+            record = self.build_record(gw_stats, disk_summary)
+            try:
+                self.output.write(json.dumps(record, separators=(',', ':')))
+                self.output.write('\n')
+                self.output.flush()
+            except IOError as err:
+                if err.errno == errno.EPIPE:
+                    # the consumer has gone away
+                    break
+                raise
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import fcntl
+import struct
+import sys
+import termios
+
+ESC = '\x1b['
+
+
+def terminal_size(out):
+    """
+    return the (rows, columns) of the terminal attached to out, or None
+    """
+    try:
+        rows, cols = struct.unpack('hh', fcntl.ioctl(out.fileno(),
+                                                     termios.TIOCGWINSZ,
+                                                     '1234'))
+    except (IOError, ValueError, AttributeError):
+        return None
+    if not rows or not cols:
+        return None
+    return rows, cols
+
+
+class Screen(object):
+    """
+    Rendering layer for the text mode. The previous frame is retained, so in
+    redraw mode only the parts of each line that have changed since the last
+    frame are written using cursor addressing. In scroll mode (or when the
+    output is not a terminal) each frame is written in full, like the output
+    of iostat
+    """
+
+    def __init__(self, out=sys.stdout, redraw=True):
+        self.out = out
+        self.redraw = redraw and out.isatty()
+        self.previous = []
+        self.size = None
+
+    def _full_frame(self, lines):
+        return ESC + 'H' + ESC + '2J' + '\n'.join(lines)
+
+    def _changed_cells(self, row, old, new):
+        """
+        return the escape sequence to turn the old line into the new one,
+        only writing from the first to the last changed character
+        """
+
+        if old == new:
+            return ''
+
+        limit = min(len(old), len(new))
+        first = 0
+        while first < limit and old[first] == new[first]:
+            first += 1
+
+        last = len(new)
+        if len(old) == len(new):
+            while last > first and old[last - 1] == new[last - 1]:
+                last -= 1
+
+        update = '{}{};{}H{}'.format(ESC, row + 1, first + 1,
+                                     new[first:last])
+        if len(new) < len(old):
+            # the line is now shorter, so clear the remainder
+            update += '{}{};{}H{}K'.format(ESC, row + 1, len(new) + 1, ESC)
+
+        return update
+
+    def draw(self, lines):
+        """
+        Write a frame to the output
+        :param lines: list of strings making up the frame
+        """
+
+        if not self.redraw:
+            self.out.write('\n' + '\n'.join(lines) + '\n')
+            self.out.flush()
+            return
+
+        size = terminal_size(self.out)
+        if size is not None:
+            # keep the frame within the terminal, so nothing scrolls
+            lines = [line[:size[1]] for line in lines[:size[0] - 1]]
+
+        if size != self.size or not self.previous:
+            output = self._full_frame(lines)
+        else:
+            updates = []
+            for row, line in enumerate(lines):
+                old = self.previous[row] if row < len(self.previous) else ''
+                updates.append(self._changed_cells(row, old, line))
+
+            if len(lines) < len(self.previous):
+                # clear the lines no longer in use
+                updates.append('{}{};1H{}J'.format(ESC, len(lines) + 1, ESC))
+
+            output = ''.join(updates)
+
+        # park the cursor below the frame
+        output += '{}{};1H'.format(ESC, len(lines) + 1)
+
+        self.out.write(output)
+        self.out.flush()
+
+        self.previous = lines
+        self.size = size
+
+    def reset(self):
+        """ forget the previous frame, forcing a full redraw """
+        self.previous = []
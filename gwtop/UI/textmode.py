@@ -4,12 +4,17 @@ __author__ = 'Paul Cuzner'
 import time
 import threading
 import sys
-import re
+import heapq
 
 from gwtop.utils.kbd import TerminalFile
-from gwtop.utils.data import bytes2human
+from gwtop.utils.data import bytes2human, clients2text
 from gwtop.UI.datamanager import summarize
-from gwtop.config.ceph import CephCluster
+from gwtop.UI.screen import Screen
+from gwtop.utils.profiler import monotonic
+
+# detail views - LUN rows, a gateway x LUN matrix and per gateway totals.
+# The 'v' key cycles through them
+VIEWS = ['luns', 'matrix', 'gateways']
 
 
 class TextMode(threading.Thread):
@@ -18,38 +23,111 @@ class TextMode(threading.Thread):
     class runs as a thread
     """
 
-    ceph_update_interval = 30
-
     def __init__(self, config, pcp_threads):
         threading.Thread.__init__(self)
         self.config = config
         self.pcp_collectors = pcp_threads
         self.terminal = None
-        self.ceph = CephCluster()
-        self.ceph_health = ''
-        self.ceph_osds = 0
-        self.max_dev_name = max([len(key) for key in self.config.devices])
+        self.refresher = None
+        self.max_dev_name = 0
+        self.device_count = None
+        self.screen = Screen(redraw=not self.config.opts.scroll)
+        self.row_formatters = {}
+        self.check_name_width()
+        self.view = self.config.opts.view
+        self.last_sample = None
+
+        # the refresher and keyboard (view change) threads both render, so
+        # a render (and the view/formatter state it uses) is serialised
+        self.render_lock = threading.Lock()
+
+        # ceph state is not available when replaying a recording or reading
+        # archives, and the rados bindings may not even be installed
+        if self.config.opts.replay or self.config.opts.archive:
+            self.ceph = None
+        else:
+            from gwtop.config.ceph import CephCluster
+            self.ceph = CephCluster(interval=self.config.opts.ceph_interval)
+
+    @staticmethod
+    def sort_field(collector, sort_key):
+        """
+        return the disk summary field to use for a sort key. Sort keys that
+        name a collector disk attribute (e.g. reads, await) use the rolled up
+        field (tot_reads, max_await)
+        """
+
+        if sort_key in collector.disk_attr:
+            sum_method = collector.disk_attr[sort_key]['sum_method']
+            prefix = 'tot' if sum_method == 'sum' else sum_method
+            return '{}_{}'.format(prefix, sort_key)
+        return sort_key
 
-    def sort_stats(self, in_dict):
+    def sort_stats(self, in_dict, candidates=None, limit=None):
         """
         sort the disk_summary by any sort keys requested, returning the
         pool/image name sequence that adheres to the sort request
         @param in_dict: dict of objects (indexed by pool/image)
+        @param candidates: device names eligible for display (default is all)
+        @param limit: number of devices required. When less than the number
+        of candidates, only the top 'limit' devices are selected (heap based)
+        instead of sorting every device
         :return: keys to use to adhere to the sort keys
         """
 
         sort_key = self.config.opts.sortkey
         reverse_mode = self.config.opts.reverse
 
+        if candidates is None:
+            candidates = list(in_dict)
+
         if sort_key == 'image':
-            sorted_keys = sorted(in_dict, reverse=reverse_mode)
+            decorated = candidates
+        elif sort_key == 'client':
+            diskmap = self.config.gateway_config.diskmap
+            decorated = [(clients2text(diskmap.get(devname, [])), devname)
+                         for devname in candidates]
+        else:
+            field = self.sort_field(self.pcp_collectors[0].collector,
+                                    sort_key)
+            decorated = [(getattr(in_dict[devname], field), devname)
+                         for devname in candidates]
+
+        if limit is not None and limit < len(decorated):
+            select = heapq.nlargest if reverse_mode else heapq.nsmallest
+            selected = select(limit, decorated)
         else:
-            sorted_keys = sorted(in_dict,
-                                 key=lambda keyname: getattr(in_dict[keyname],
-                                                             sort_key),
-                                 reverse=reverse_mode)
+            selected = sorted(decorated, reverse=reverse_mode)
+
+        if sort_key == 'image':
+            return selected
+        return [devname for _value, devname in selected]
+
+    def check_name_width(self):
+        """
+        Establish the width of the device name column. LUNs may be added
+        while running (e.g. when reading archives), so the width is checked
+        whenever the number of devices changes
+        """
+        devices = self.config.devices
+        if len(devices) == self.device_count:
+            return
+        self.device_count = len(devices)
 
-        return sorted_keys
+        width = max([len(key) for key in devices] or [len("Pool.Image")])
+        if width != self.max_dev_name:
+            self.max_dev_name = width
+            self.row_formatters = {}
+
+    def get_row_formatter(self, collector):
+        """
+        return the collector's device row formatter, compiled once for the
+        device name width in use
+        """
+        if collector not in self.row_formatters:
+            self.row_formatters[collector] = collector.row_formatter(
+                self.max_dev_name, rates=self.config.opts.rates)
+        return self.row_formatters[collector]
 
     def show_stats(self, gw_stats, disk_summary):
         """
@@ -60,102 +138,268 @@ class TextMode(threading.Thread):
         :return: nothing
         """
 
+        with self.render_lock:
+            self.render(gw_stats, disk_summary)
+
+    def render(self, gw_stats, disk_summary):
+        """
+        Build and draw the frame for a sample, called with the render_lock
+        held
+        """
+
+        start = monotonic()
+        profiler = self.config.profiler
+        frame = []
+
         num_gws = len(gw_stats.cpu_busy)
         desc = "Gateways" if num_gws > 1 else "Gateway"
         total_gateways = len(self.config.gateway_config.gateways)
-        total_disks = len(disk_summary.keys())
+        total_disks = len(self.config.devices)
         gw_summary = "{}/{}".format(num_gws, total_gateways)
 
-        # take the first disk we have to determine the pcp collector class
-        # used, then use the methods of this class for header and row
-        # detail layout
-        first_disk = disk_summary.itervalues().next()
-        collector = first_disk.collector
-
-        print("\ngwtop  {:>3} {:<8}   CPU% MIN:{:>3.0f} MAX:{:>3.0f}    "
-              "Network Total In:{:>6}  Out:{:>6}"
-              "   {}".format(gw_summary,
-                             desc,
-                             gw_stats.min_cpu,
-                             gw_stats.max_cpu,
-                             bytes2human(gw_stats.total_net_in),
-                             bytes2human(gw_stats.total_net_out),
-                             gw_stats.timestamp))
-
-        print("Capacity:{:>5}    Disks:{:>4}   IOPS:{:>5}   Clients:{:>3}   Ceph: {:<16}   "
-              "OSDs:{:>4}".format(
-                                  bytes2human(gw_stats.total_capacity),
-                                  total_disks,
-                                  gw_stats.total_iops,
-                                  self.config.gateway_config.client_count,
-                                  self.ceph_health,
-                                  self.ceph_osds))
+        # flag samples released by the sync deadline without every gateway
+        if gw_stats.partial and gw_stats.timestamp != 'NO DATA':
+            sync_state = "PARTIAL({}/{})".format(num_gws - len(gw_stats.missing),
+                                                 num_gws)
+        else:
+            sync_state = ''
+
+        # with a rate window selected, the gateway cpu and network load are
+        # shown for the same window as the LUN rates
+        rates = self.config.opts.rates
+        if rates == 'interval' or not gw_stats.rates:
+            cpu_busy = gw_stats.cpu_busy
+            net_in = gw_stats.total_net_in
+            net_out = gw_stats.total_net_out
+        else:
+            gw_rates = gw_stats.rates.values()
+            cpu_busy = [gw['cpu_busy_{}'.format(rates)] for gw in gw_rates]
+            net_in = sum([gw['net_in_{}'.format(rates)] for gw in gw_rates])
+            net_out = sum([gw['net_out_{}'.format(rates)] for gw in gw_rates])
+            sync_state = "Rates:{} {}".format(rates, sync_state)
+
+        frame.append("gwtop  {:>3} {:<8}   CPU% MIN:{:>3.0f} MAX:{:>3.0f}    "
+                     "Network Total In:{:>6}  Out:{:>6}"
+                     "   {} {}".format(gw_summary,
+                                       desc,
+                                       min(cpu_busy),
+                                       max(cpu_busy),
+                                       bytes2human(net_in),
+                                       bytes2human(net_out),
+                                       gw_stats.timestamp,
+                                       sync_state))
+
+        if self.ceph is None:
+            ceph_health, ceph_osds = '', 0
+        else:
+            ceph_health, ceph_osds = self.ceph.health, self.ceph.osds
+
+        frame.append("Capacity:{:>5}    Disks:{:>4}   IOPS:{:>5}   Clients:{:>3}   Ceph: {:<16}   "
+                     "OSDs:{:>4}".format(
+                                         bytes2human(gw_stats.total_capacity),
+                                         total_disks,
+                                         gw_stats.total_iops,
+                                         self.config.gateway_config.client_count,
+                                         ceph_health,
+                                         ceph_osds))
+
+        if profiler.enabled:
+            frame.append(profiler.status_line())
+
+        sort_time = 0.0
+        if self.view == 'gateways':
+            frame.extend(self.gateway_rows(gw_stats))
+        else:
+            sort_time = self.lun_rows(frame, gw_stats, disk_summary)
+
+        self.screen.draw(frame)
+        self.last_sample = (gw_stats, disk_summary)
+        profiler.record('render', monotonic() - start - sort_time)
+
+    def lun_rows(self, frame, gw_stats, disk_summary):
+        """
+        Add the LUN detail to the frame, as a row per LUN or a gateway x LUN
+        matrix depending on the view
+        :return: time taken to sort the LUNs (secs)
+        """
+
+        collector = self.pcp_collectors[0].collector
+        profiler = self.config.profiler
 
         # Get the headings from the specific collector used for the device
         # detail
-        headings = collector.headers(self.max_dev_name)
-        print(headings)
+        self.check_name_width()
+        if self.view == 'matrix':
+            attr = self.matrix_attr(collector)
+            format_row = self.matrix_formatter(collector, gw_stats, attr)
+            frame.append(format_row(None, None, None))
+        else:
+            frame.append(collector.headers(self.max_dev_name))
+            format_row = self.get_row_formatter(collector)
+
+        # disk_summary only holds the devices that pass the device filter,
+        # so apply the busy filter before sorting
+        opts = self.config.opts
+        if opts.busy_only:
+            candidates = [devname for devname in disk_summary
+                          if disk_summary[devname].tot_iops > 0]
+        else:
+            candidates = list(disk_summary)
 
         # Metrics shown sorted by pool/image name by default
+        diskmap = self.config.gateway_config.diskmap
         devices_shown = False
-        devices_count = 0
-        for devname in self.sort_stats(disk_summary):
+        sort_start = monotonic()
+        sorted_devices = self.sort_stats(disk_summary, candidates, opts.limit)
+        sort_time = monotonic() - sort_start
+        profiler.record('sort', sort_time)
 
-            if devname in self.config.gateway_config.diskmap:
-                client = self.config.gateway_config.diskmap[devname]
-            else:
-                client = ''
+        for devname in sorted_devices:
 
-            lun = disk_summary[devname]
-            if ((lun.tot_iops > 0 and self.config.opts.busy_only) or
-                not self.config.opts.busy_only):
+            client = clients2text(diskmap.get(devname, []))
 
-                # eligible to display, so just check the limit set
-                devices_count += 1
-                if devices_count <= self.config.opts.limit:
+            frame.append(format_row(devname, disk_summary[devname], client))
+            devices_shown = True
 
-                    if re.search(self.config.opts.device_filter,
-                                 devname):
+        if not devices_shown:
+            if not self.config.lun_filter.active:
+                filter_text = ""
+            else:
+                filter_text = "(device filter : {})".format(self.config.lun_filter.describe())
 
-                        device_row = collector.print_device_data(devname,
-                                                                 self.max_dev_name,
-                                                                 lun,
-                                                                 client)
-                        print(device_row)
-                        devices_shown = True
+            frame.append("- No active LUNs {}".format(filter_text))
 
+        return sort_time
 
-        if not devices_shown:
-            if self.config.opts.device_filter == ".*":
-                filter_text = ""
+    def matrix_attr(self, collector):
+        """
+        return the disk attribute shown in the matrix view - the sort key's
+        attribute, or iops
+        """
+        attr = collector.field_attr(self.config.opts.sortkey)
+        return attr if attr in collector.disk_attr else 'iops'
+
+    def matrix_formatter(self, collector, gw_stats, attr):
+        """
+        return a function that formats a LUN row of the matrix view; the
+        value of an attribute on each gateway, the rolled up value and for
+        summed attributes, the largest share taken by a single gateway (100%
+        means all the LUN's I/O is on one gateway). Called with a devname of
+        None, it returns the heading
+        """
+
+        gateways = gw_stats.gateways
+        columns = gw_stats.lun_matrix.get(attr, [])
+        index = gw_stats.lun_index
+        summed = collector.disk_attr[attr]['sum_method'] == 'sum'
+
+        fmt = ("{:<%d}" % self.max_dev_name +
+               " {:>10.2f}" * len(gateways) +
+               " {:>10.2f}   {:>5}").format
+
+        def formatter(devname, disk_data, client):
+            if devname is None:
+                return ("{:<{}}".format("Pool.Image", self.max_dev_name) +
+                        ''.join(" {:>10}".format(gateway[:10])
+                                for gateway in gateways) +
+                        " {:>10}   {:>5}   ({} per gateway)".format(
+                            "Total" if summed else "Max",
+                            "Max%" if summed else "", attr))
+
+            pos = index.get(devname)
+            values = [column[pos] for column in columns] if pos is not None \
+                else [0.0] * len(columns)
+            if summed:
+                total = sum(values)
+                share = "{:.0f}".format(max(values) / total * 100) \
+                    if total else ''
             else:
-                filter_text = "(device filter : {})".format(self.config.opts.device_filter)
+                total = max(values) if values else 0.0
+                share = ''
+            return fmt(devname, *(values + [total, share]))
 
-            print("- No active LUNs {}".format(filter_text))
+        return formatter
 
+    def gateway_rows(self, gw_stats):
+        """
+        return the lines of the gateway view; the cpu and network load of
+        each gateway, the number of LUNs with I/O, and the gateway's totals
+        of the columns shown
+        """
+
+        collector = self.pcp_collectors[0].collector
+        fields = []
+        for column in collector.selected_columns():
+            attr = column.get('attr')
+            if attr is None:
+                continue
+            sum_method = collector.disk_attr[attr]['sum_method']
+            fields.append(('{}_{}'.format('tot' if sum_method == 'sum'
+                                          else sum_method, attr),
+                           column['header'].strip(),
+                           column.get('convert')))
+        if 'tot_iops' not in [field for field, _label, _convert in fields]:
+            fields.insert(0, ('tot_iops', 'iops', int))
+
+        width = max([len(gateway.hostname)
+                     for gateway in self.pcp_collectors] + [8])
+
+        lines = ["{:<{}}   CPU%    Net In   Net Out    LUNs".format("Gateway",
+                                                                 width) +
+                 ''.join(" {:>10}".format(label[:10])
+                         for _field, label, _convert in fields)]
+
+        for pos, gateway in enumerate(self.pcp_collectors):
+            hostname = gateway.hostname
+            line = "{:<{}}  {:>5.0f}  {:>8}  {:>8}".format(
+                hostname, width,
+                gw_stats.cpu_busy[pos],
+                bytes2human(gw_stats.net_in[pos]),
+                bytes2human(gw_stats.net_out[pos]))
+
+            totals = gw_stats.gateway_totals.get(hostname)
+            if totals is None:
+                lines.append(line + "    - no data for this sample")
+                continue
+
+            line += "  {:>6}".format(totals['active_luns'])
+            for field, _label, convert in fields:
+                value = totals.get(field, 0.0)
+                if convert:
+                    value = convert(value)
+                line += (" {:>10}" if isinstance(value, int)
+                         else " {:>10.2f}").format(value)
+            lines.append(line)
+
+        return lines
+
+    def next_view(self):
+        """ switch to the next view, redrawing the last sample """
+        with self.render_lock:
+            self.view = VIEWS[(VIEWS.index(self.view) + 1) % len(VIEWS)]
+            if self.last_sample is not None:
+                self.render(*self.last_sample)
 
     def reset(self):
         """
         return the console environment to normal
         """
+        if self.ceph is not None:
+            self.ceph.stop()
         self.terminal.reset()
 
-    def update_ceph(self):
-        """
-        Run the ceph objects health method at regular intervals
-        """
-        self.ceph.update_state()
-        self.ceph_health = self.ceph.health
-        self.ceph_osds = self.ceph.osds
-        threading.Timer(TextMode.ceph_update_interval, self.update_ceph).start()
-
     def refresh_display(self):
         """
-        Aggregate the stats, and display at a set interval
+        Aggregate the stats, and display them each time the collectors
+        complete a sample (summarize waits for the next epoch). The loop ends
+        when the samples are exhausted (i.e. a replay has completed)
         """
-        gw_stats, disk_summary = summarize(self.config, self.pcp_collectors)
-        self.show_stats(gw_stats, disk_summary)
-        threading.Timer(self.config.sample_interval, self.refresh_display).start()
+        while True:
+            gw_stats, disk_summary = summarize(self.config,
+                                               self.pcp_collectors)
+            if gw_stats.timestamp == 'NO DATA' and self.config.barrier.closed:
+                break
+            self.show_stats(gw_stats, disk_summary)
 
     def run(self):
         """
@@ -166,18 +410,24 @@ class TextMode(threading.Thread):
         term = TerminalFile(sys.stdin)
         self.terminal = term
 
-        # start the periodic functions
-        self.update_ceph()
-        self.refresh_display()
+        # the ceph state is refreshed in the background
+        if self.ceph is not None:
+            self.ceph.start()
+
+        self.refresher = threading.Thread(target=self.refresh_display)
+        self.refresher.daemon = True
+        self.refresher.start()
 
         # Loop to handle ctrl-c or 'q' interaction with the user
-        while 1:
+        while self.refresher.isAlive():
             try:
                 time.sleep(0.5)
 
                 c = term.getch()
                 if c == 'q':
                     break
+                elif c == 'v':
+                    self.next_view()
             except KeyboardInterrupt:
                 print "breaking from thread"
                 break
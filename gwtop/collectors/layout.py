@@ -0,0 +1,449 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import re
+from operator import attrgetter
+
+from gwtop.utils.data import bytes2human
+from gwtop.utils.smoothing import RATE_CHOICES
+
+# summary fields derived from the await histograms, rather than a disk
+# attribute
+PERCENTILE_FIELDS = ['p50_await', 'p95_await', 'p99_await']
+
+# display format of a custom metric column - [align]width[.precision]type
+# e.g. 8.2f (the default), <10.1f or 6d
+CUSTOM_FORMAT = re.compile(r'^([<>^]?)(\d+)(?:\.(\d+))?([fd])$')
+
+
+def rate_field(attr, rates='interval'):
+    """
+    return the disk summary field holding a summed attribute for the rate
+    window in use e.g. tot_iops (last interval) or iops_5m
+    """
+    if rates == 'interval':
+        return 'tot_{}'.format(attr)
+    return '{}_{}'.format(attr, rates)
+
+
+def custom_attr(name, spec):
+    """
+    Build a disk attribute and display column for a metric defined in the
+    config file(s) as <pcp metric>[:<semantics>[:<sum_method>[:<format>]]]
+    e.g. metric.sessions = lio.lun.sessions:value:sum:6d
+    :param name: attribute name
+    :param spec: metric specification string
+    :return: (disk attribute dict, column dict)
+    """
+
+    parts = [part.strip() for part in spec.split(':')]
+    metric = parts[0]
+    semantics = parts[1] if len(parts) > 1 and parts[1] else 'rate'
+    sum_method = parts[2] if len(parts) > 2 and parts[2] else 'sum'
+    display = CUSTOM_FORMAT.match(parts[3] if len(parts) > 3 and parts[3]
+                                  else '8.2f')
+
+    if not metric or semantics not in ['rate', 'value'] or \
+            sum_method not in ['sum', 'max'] or display is None or \
+            len(parts) > 4:
+        raise ValueError("invalid metric definition '{}'".format(spec))
+
+    align, width, precision, value_type = display.groups()
+    align = align or '>'
+    width = int(width)
+    attr = {'sum_method': sum_method,
+            'semantics': semantics,
+            'metrics': [metric]}
+    column = {'name': name,
+              'header': ' {:{}{}}'.format(name[:width], align, width),
+              'format': ' {{:{}{}{}{}}}'.format(align, width,
+                                               '.' + precision if precision
+                                               else '',
+                                               value_type),
+              'attr': name}
+    if value_type == 'd':
+        column['convert'] = round_int
+
+    return attr, column
+
+
+class Layout(object):
+    """
+    Registry of the disk attributes a pcp provider can collect, and the
+    columns that can be shown for them.
+
+    Each disk attribute declares the pcp metrics it's derived from, how
+    they're converted (semantics), and how the values from each gateway are
+    combined (sum_method);
+      rate  : sum of the metrics' counter deltas / interval (x scale)
+      ratio : sum of the metrics' deltas / sum of the 'per' metrics' deltas
+      value : the current value of the metric (instantaneous)
+    A layout covering more than one provider also declares, per attribute,
+    the metrics and semantics to use for each additional provider. Each
+    provider only extracts the attributes whose metrics are in it's own
+    instance domain (metric_prefix)
+
+    Each column names the attribute (or summary field) it shows, it's
+    heading and row format. The layout used at run time is a subclass
+    created by 'configure', holding just the selected columns and the
+    attributes they need - so only the pcp metrics that are shown are
+    fetched
+    """
+
+    disk_attr = {}
+    column_defs = []
+    columns = []
+
+    # attributes needed regardless of the columns shown (busy-only, top n,
+    # io source and the gateway totals all use iops)
+    required_attr = ['iops']
+
+    # providers whose metrics are declared by an attribute, in addition to
+    # the attribute's own metrics
+    alt_providers = []
+
+    # prefix of the pcp metrics sharing the provider's disk instances
+    metric_prefix = ''
+
+    @classmethod
+    def column_names(cls):
+        return [column['name'] for column in cls.column_defs]
+
+    @classmethod
+    def default_columns(cls, percentiles=False):
+        return list(cls.columns)
+
+    @classmethod
+    def field_attr(cls, field):
+        """
+        return the disk attribute a summary or sort field is derived from
+        e.g. tot_reads, reads_5m -> reads
+        """
+
+        if field in PERCENTILE_FIELDS:
+            return 'await' if 'await' in cls.disk_attr else None
+
+        name = field
+        for prefix in ['tot_', 'max_']:
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+        for rate in RATE_CHOICES[1:]:
+            if name.endswith('_' + rate):
+                name = name[:-len(rate) - 1]
+
+        return name if name in cls.disk_attr else None
+
+    @classmethod
+    def configure(cls, columns=None, custom=None, fields=None):
+        """
+        Return the layout to use at run time
+        :param columns: names of the columns to show (default columns if
+        None)
+        :param custom: dict of additional attribute name -> (disk attribute,
+        column) defined in the config file(s)
+        :param fields: other summary fields that must be available e.g. the
+        sort key
+        :return: subclass of the layout, holding the selected columns and
+        the disk attributes they need
+        """
+
+        disk_attr = dict(cls.disk_attr)
+        column_defs = list(cls.column_defs)
+        for name in sorted(custom or {}):
+            attr, column = custom[name]
+            disk_attr[name] = attr
+            column_defs.append(column)
+
+        columns_by_name = dict((column['name'], column)
+                               for column in column_defs)
+
+        if columns is None:
+            columns = cls.columns + sorted(custom or {})
+
+        unknown = [name for name in columns if name not in columns_by_name]
+        if unknown:
+            raise ValueError("unknown column(s) {}".format(','.join(unknown)))
+
+        selected = [columns_by_name[name] for name in columns]
+
+        layout = type(cls.__name__, (cls,), {'disk_attr': disk_attr,
+                                             'column_defs': column_defs,
+                                             'columns': list(columns)})
+
+        needed = set(cls.required_attr)
+        for column in selected:
+            needed.update(column.get('attrs', []))
+            if 'attr' in column:
+                needed.add(column['attr'])
+        for field in (fields or []):
+            attr = layout.field_attr(field)
+            if attr:
+                needed.add(attr)
+
+        layout.disk_attr = dict((name, disk_attr[name]) for name in needed)
+        return layout
+
+    @classmethod
+    def pcp_metrics(cls):
+        """ return the pcp metrics needed for the layout's disk attributes """
+
+        metrics = set()
+        for attr in cls.disk_attr.values():
+            for defn in [attr] + [attr[provider] for provider
+                                  in cls.alt_providers if provider in attr]:
+                metrics.update(defn['metrics'])
+                metrics.update(defn.get('per', []))
+        return sorted(metrics)
+
+    @classmethod
+    def provider_layout(cls, provider):
+        """
+        return the layout of the attributes a provider supplies, using the
+        provider's metrics. Attributes whose metrics belong to another
+        provider's instance domain (e.g. a lio.lun.* metric defined in the
+        config file) are left out, so they're never aligned against the
+        wrong instances
+        """
+
+        if not cls.alt_providers:
+            return cls
+
+        prefix = layout_lookup[provider].metric_prefix
+        disk_attr = {}
+        for name, attr in cls.disk_attr.items():
+            defn = dict(attr.get(provider, attr),
+                        sum_method=attr['sum_method'])
+            if all(metric.startswith(prefix)
+                   for metric in defn['metrics'] + defn.get('per', [])):
+                disk_attr[name] = defn
+        return type(cls.__name__, (cls,), {'disk_attr': disk_attr})
+
+    @classmethod
+    def selected_columns(cls):
+        columns_by_name = dict((column['name'], column)
+                               for column in cls.column_defs)
+        return [columns_by_name[name] for name in cls.columns]
+
+    @classmethod
+    def headers(cls, max_rbd_name):
+        return (cls.header_prefix.format("Pool.Image", max_rbd_name) +
+                ''.join(column['header'] for column in cls.selected_columns()) +
+                cls.header_suffix)
+
+    @classmethod
+    def row_formatter(cls, max_rbd_name, rates='interval'):
+        """
+        return a function that formats a device row, with the format string
+        compiled once for the given device name width. rates selects the
+        window used for the summed attributes
+        """
+
+        columns = cls.selected_columns()
+        fmt = ((cls.row_prefix % max_rbd_name) +
+               ''.join(column['format'] for column in columns) +
+               cls.row_suffix).format
+
+        fields = []
+        converters = []
+        for column in columns:
+            if 'attr' in column:
+                attr = column['attr']
+                sum_method = cls.disk_attr[attr]['sum_method']
+                if sum_method == 'sum':
+                    fields.append(rate_field(attr, rates))
+                else:
+                    fields.append('{}_{}'.format(sum_method, attr))
+            else:
+                fields.append(column['field'])
+            converters.append(column.get('convert'))
+
+        if len(fields) == 1:
+            # attrgetter returns a scalar rather than a tuple for one field
+            def get_fields(disk_data):
+                return (getattr(disk_data, fields[0]),)
+        else:
+            get_fields = attrgetter(*fields)
+        fixed_values = cls.fixed_values
+
+        if any(converters):
+            def get_values(disk_data):
+                return [convert(value) if convert else value
+                        for convert, value in zip(converters,
+                                                  get_fields(disk_data))]
+        else:
+            get_values = get_fields
+
+        def formatter(devname, disk_data, client):
+            return fmt(*(fixed_values(devname, disk_data) +
+                         tuple(get_values(disk_data)) + (client,)))
+
+        return formatter
+
+    @classmethod
+    def print_device_data(cls, devname, max_dev_name, disk_data, client):
+        return cls.row_formatter(max_dev_name)(devname, disk_data, client)
+
+
+def kb2mb(value):
+    return value / 1024
+
+
+def round_int(value):
+    return int(round(value))
+
+
+class LIOLayout(Layout):
+    """
+    Disk attributes and display layout of the metrics provided by the lio
+    pmda
+    """
+
+    # latency isn't provided by the lio pmda
+    disk_attr = {
+                'iops': {'sum_method': 'sum',
+                         'semantics': 'rate',
+                         'metrics': ['lio.lun.iops']},
+                'read_mb': {'sum_method': 'sum',
+                            'semantics': 'rate',
+                            'metrics': ['lio.lun.read_mb']},
+                'write_mb': {'sum_method': 'sum',
+                             'semantics': 'rate',
+                             'metrics': ['lio.lun.write_mb']}
+                }
+
+    column_defs = [
+        {'name': 'iops', 'header': '     iops', 'format': '    {:>5}',
+         'attr': 'iops', 'convert': round_int},
+        {'name': 'read_mb', 'header': '     rMB/s', 'format': '    {:>6.2f}',
+         'attr': 'read_mb'},
+        {'name': 'write_mb', 'header': '     wMB/s', 'format': '    {:>6.2f}',
+         'attr': 'write_mb'}
+        ]
+
+    columns = ['iops', 'read_mb', 'write_mb']
+
+    metric_prefix = 'lio.lun.'
+
+    header_prefix = "{:<{}}    Src    Size"
+    header_suffix = "   Client"
+    row_prefix = "{:<%d}    {:^3}    {:>4}"
+    row_suffix = "   {:<20}"
+
+    @staticmethod
+    def fixed_values(devname, disk_data):
+        return (devname,
+                disk_data.io_source,
+                bytes2human(disk_data.disk_size))
+
+
+class DMLayout(Layout):
+    """
+    Disk attributes and display layout of the device-mapper metrics provided
+    by the linux pmda
+    """
+
+    disk_attr = {
+        'iops': {'sum_method': 'sum',
+                 'semantics': 'rate',
+                 'metrics': ['disk.dm.read', 'disk.dm.write']},
+        'reads': {'sum_method': 'sum',
+                  'semantics': 'rate',
+                  'metrics': ['disk.dm.read']},
+        'writes': {'sum_method': 'sum',
+                   'semantics': 'rate',
+                   'metrics': ['disk.dm.write']},
+        'readkb': {'sum_method': 'sum',
+                   'semantics': 'rate',
+                   'metrics': ['disk.dm.read_bytes']},
+        'writekb': {'sum_method': 'sum',
+                    'semantics': 'rate',
+                    'metrics': ['disk.dm.write_bytes']},
+        'await': {'sum_method': 'max',
+                  'semantics': 'ratio',
+                  'metrics': ['disk.dm.read_rawactive',
+                              'disk.dm.write_rawactive'],
+                  'per': ['disk.dm.read', 'disk.dm.write']},
+        'r_await': {'sum_method': 'max',
+                    'semantics': 'ratio',
+                    'metrics': ['disk.dm.read_rawactive'],
+                    'per': ['disk.dm.read']},
+        'w_await': {'sum_method': 'max',
+                    'semantics': 'ratio',
+                    'metrics': ['disk.dm.write_rawactive'],
+                    'per': ['disk.dm.write']}
+        }
+
+    column_defs = [
+        {'name': 'reads', 'header': '     r/s', 'format': '   {:>5}',
+         'attr': 'reads', 'convert': int},
+        {'name': 'writes', 'header': '     w/s', 'format': '   {:>5}',
+         'attr': 'writes', 'convert': int},
+        {'name': 'readkb', 'header': '    rMB/s', 'format': '   {:>6.2f}',
+         'attr': 'readkb', 'convert': kb2mb},
+        {'name': 'writekb', 'header': '     wMB/s', 'format': '    {:>6.2f}',
+         'attr': 'writekb', 'convert': kb2mb},
+        {'name': 'await', 'header': '    await', 'format': '   {:>6.2f}',
+         'attr': 'await'},
+        {'name': 'r_await', 'header': '  r_await', 'format': '   {:>6.2f}',
+         'attr': 'r_await'},
+        {'name': 'w_await', 'header': '  w_await', 'format': '   {:>6.2f}',
+         'attr': 'w_await'},
+        {'name': 'p50', 'header': '      p50', 'format': '   {:>6.2f}',
+         'field': 'p50_await', 'attrs': ['await']},
+        {'name': 'p95', 'header': '      p95', 'format': '   {:>6.2f}',
+         'field': 'p95_await', 'attrs': ['await']},
+        {'name': 'p99', 'header': '      p99', 'format': '   {:>6.2f}',
+         'field': 'p99_await', 'attrs': ['await']}
+        ]
+
+    columns = ['reads', 'writes', 'readkb', 'writekb', 'await', 'r_await',
+               'w_await']
+
+    metric_prefix = 'disk.dm.'
+
+    header_prefix = "{:<{}}  Src  Device   Size"
+    header_suffix = "  Client"
+    row_prefix = "{:<%d}  {:^3}  {:^6}   {:>4}"
+    row_suffix = "  {:<20}"
+
+    @classmethod
+    def default_columns(cls, percentiles=False):
+        """ with percentiles, the read/write await are replaced by p50-p99 """
+        if percentiles:
+            return ['reads', 'writes', 'readkb', 'writekb', 'await',
+                    'p50', 'p95', 'p99']
+        return list(cls.columns)
+
+    @staticmethod
+    def fixed_values(devname, disk_data):
+        return (devname,
+                disk_data.io_source,
+                disk_data.rbd_name,
+                bytes2human(disk_data.disk_size))
+
+
+class CombinedLayout(DMLayout):
+    """
+    Disk attributes and display layout for gateways with both dm (krbd)
+    and lio (TCMU user) backed LUNs. The dm attributes are used, with the
+    iops and throughput of the LUNs that aren't dm devices taken from the
+    lio pmda. Latency is only available for the dm LUNs
+    """
+
+    alt_providers = ['lio']
+
+    disk_attr = dict((name, dict(attr)) for name, attr
+                     in DMLayout.disk_attr.items())
+    disk_attr['iops']['lio'] = {'semantics': 'rate',
+                                'metrics': ['lio.lun.iops']}
+    disk_attr['readkb']['lio'] = {'semantics': 'rate',
+                                  'metrics': ['lio.lun.read_mb'],
+                                  'scale': 1024}
+    disk_attr['writekb']['lio'] = {'semantics': 'rate',
+                                   'metrics': ['lio.lun.write_mb'],
+                                   'scale': 1024}
+
+
+layout_lookup = {'dm': DMLayout,
+                 'lio': LIOLayout,
+                 'combined': CombinedLayout}
@@ -1,31 +1,23 @@
 #!/usr/bin/env pmpython
 
 import threading
+import time
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter, sub
 
 from pcp import pmapi, pmcc
-from gwtop.config.generic import DiskMetrics, GatewayMetrics
-from gwtop.utils.data import bytes2human
+from cpmapi import PM_TYPE_32, PM_TYPE_U32
+from gwtop.config.generic import GatewayMetrics
+from gwtop.collectors.layout import layout_lookup
+from gwtop.utils.samples import SampleRing, SAMPLE_HISTORY
+from gwtop.utils.profiler import Profiler, monotonic
 
 import re
 import os
-import glob
+import fnmatch
 from rtslib_fb.utils import fread
 
-# group metrics
-DISK_METRICS = {"dm": ['disk.dm.read',
-                       'disk.dm.read_bytes',
-                       'disk.dm.write',
-                       'disk.dm.write_bytes',
-                       'disk.dm.read_rawactive',
-                       'disk.dm.write_rawactive'
-                       ],
-                "lio": ['lio.lun.iops',
-                        'lio.lun.read_mb',
-                        'lio.lun.write_mb'
-                        ]
-                 }
-
-
+# gateway metrics. The disk metrics fetched are defined by the layout
 NETWORK_METRICS = ['network.interface.in.bytes',
                    'network.interface.out.bytes']
 
@@ -36,44 +28,154 @@ CPU_METRICS = ['kernel.all.cpu.idle',
                'kernel.all.cpu.intr',
                'hinv.ncpu']
 
+# cpu time counters that make up the busy %
+CPU_BUSY_METRICS = ['kernel.all.cpu.sys',
+                    'kernel.all.cpu.user',
+                    'kernel.all.cpu.intr']
+
+# a 32 bit counter that goes backwards has wrapped. Counters of other types
+# are only taken to have wrapped when the previous value was within
+# COUNTER32_MARGIN of the 32 bit limit, otherwise they have been reset
+COUNTER32_MAX = 0xffffffff
+COUNTER32_MARGIN = 1 << 28
+
+
+def sum_columns(columns):
+    """
+    return the element-wise sum of a list of columns. The sum is None for
+    any position where a column has no value
+    """
+    if len(columns) == 1:
+        return columns[0]
+    return [None if None in values else sum(values)
+            for values in zip(*columns)]
+
+
+def counter_delta(cur, prev, counter32=False):
+    """
+    return the delta between two samples of a counter, allowing for a 32 bit
+    counter wrap. None is returned when either value is missing, or the
+    counter has been reset (e.g. the device was recreated)
+    :param counter32: True if the metric is a 32 bit type
+    """
+    if cur is None or prev is None:
+        return None
+    if cur >= prev:
+        return cur - prev
+    if prev <= COUNTER32_MAX and (counter32 or
+                                  prev > COUNTER32_MAX - COUNTER32_MARGIN):
+        return cur + COUNTER32_MAX + 1 - prev
+    return None
+
+
 class CollectorError(Exception):
     pass
 
 
 class RBDMap(object):
+    """
+    dm name -> pool/rbd_image lookup table. The table is maintained
+    incrementally; /dev/mapper is only re-listed when its mtime shows that
+    devices have been added or removed, and only the new devices are
+    resolved through sysfs. dm names that can't be resolved are held in a
+    negative cache until /dev/mapper changes again
+    """
 
-    def __init__(self):
+    mapper_dir = '/dev/mapper'
+    dm_pattern = '[0-255]-*'
+
+    def __init__(self, required=True):
+        """
+        :param required: raise CollectorError if no rbd devices are found
+        """
         self.map = {}
+        self.unknown = set()
+        self.mapper_mtime = None
         self.refresh()
 
-    def refresh(self):
-        self._get_map()
-
-        if not self.map:
+        if required and not self.map:
             raise CollectorError("RBDMAP: Unable to create the "
                                  "dm -> rbd_name lookup table")
 
-    def _get_map(self):
+    def lookup(self, dm_name):
+        """
+        return the map entry for a dm name, or None if it's not an rbd
+        device we can resolve
+        :param dm_name: dm device name e.g. 0-198baf12200854
+        :return: dict or None
+        """
+
+        if dm_name not in self.map:
+            if dm_name in self.unknown and not self.changed():
+                return None
+            self.refresh()
+            if dm_name not in self.map:
+                self.unknown.add(dm_name)
+                return None
+
+        return self.map[dm_name]
+
+    def changed(self):
+        """ return True if devices have been added/removed from /dev/mapper """
+        try:
+            return os.stat(self.mapper_dir).st_mtime != self.mapper_mtime
+        except OSError:
+            return True
+
+    def refresh(self):
+        """
+        Bring the map in line with the content of /dev/mapper, resolving
+        only the devices that have been added since the last refresh
+        """
+
+        if not self.changed():
+            return
+
+        try:
+            self.mapper_mtime = os.stat(self.mapper_dir).st_mtime
+            dm_devices = set(fnmatch.filter(os.listdir(self.mapper_dir),
+                                            RBDMap.dm_pattern))
+        except OSError:
+            self.mapper_mtime = None
+            dm_devices = set()
+
+        for key in set(self.map) - dm_devices:
+            del self.map[key]
+
+        # the state of /dev/mapper has changed, so previous misses may now
+        # resolve
+        self.unknown.clear()
+
+        for key in dm_devices - set(self.map):
+            entry = self._resolve(key)
+            if entry:
+                self.map[key] = entry
+            else:
+                self.unknown.add(key)
+
+    def _resolve(self, key):
         """
-        Convert dm devices into their pool/rbd_image name. All gateway nodes
+        Convert a dm device into its pool/rbd_image name. All gateway nodes
         should see the same rbds, and each rbd when mapped through device
         mapper will have the same name, so this gives us a common reference
         point.
+        :param key: dm device name e.g. 0-198baf12200854
+        :return: dict or None if the device can't be resolved
         """
 
-        dm_devices = glob.glob('/dev/mapper/[0-255]-*')
-
-        if dm_devices:
-            for dm_path in dm_devices:
-                key = os.path.basename(dm_path)                     # e.g. 0-198baf12200854
-                dm_id = os.path.realpath(dm_path).split('/')[-1]    # e.g. dm-4
-                rbd_device = os.listdir('/sys/class/block/{}/slaves'.format(dm_id))[0]    # rbdX
-                rbd_num = rbd_device[3:]                            # X
-                pool = fread('/sys/devices/rbd/{}/pool'.format(rbd_num))
-                image = fread('/sys/devices/rbd/{}/name'.format(rbd_num))
+        dm_path = os.path.join(self.mapper_dir, key)
+        try:
+            dm_id = os.path.realpath(dm_path).split('/')[-1]    # e.g. dm-4
+            rbd_device = os.listdir('/sys/class/block/{}/slaves'.format(dm_id))[0]    # rbdX
+            rbd_num = rbd_device[3:]                            # X
+            pool = fread('/sys/devices/rbd/{}/pool'.format(rbd_num))
+            image = fread('/sys/devices/rbd/{}/name'.format(rbd_num))
+        except (OSError, IOError, IndexError):
+            # device removed while we looked at it, or not an rbd
+            return None
 
-                self.map[key] = {"rbd_name": "{}.{}".format(pool, image),
-                                 "rbd_dev": rbd_device}
+        return {"rbd_name": "{}.{}".format(pool, image),
+                "rbd_dev": rbd_device}
 
 
 class IOstatOptions(pmapi.pmOptions):
@@ -83,18 +185,44 @@ class IOstatOptions(pmapi.pmOptions):
     """
 
     def __init__(self, host):
-        pmapi.pmOptions.__init__(self, "h:t:")
+        pmapi.pmOptions.__init__(self, "a:h:t:A:S:T:")
+        self.pmSetLongOptionArchive()
         self.pmSetLongOptionHost()
         self.pmSetLongOptionInterval()
+        self.pmSetLongOptionAlign()
+        self.pmSetLongOptionStart()
+        self.pmSetLongOptionFinish()
 
 class PCPbase(pmcc.MetricGroupPrinter):
 
     NIC_BLACKLIST = ['lo', 'docker0']
     HDRcount = 0
 
-    def __init__(self, metrics):
+    def __init__(self, metrics, layout):
+        """
+        :param metrics: GatewayMetrics object the samples are written to
+        :param layout: layout defining the disk attributes to extract
+        """
         pmcc.MetricGroupPrinter.__init__(self)
         self.metrics = metrics
+        self.listeners = []
+        self.layout = layout
+
+        disk_attr = layout.disk_attr
+        self.attrs = sorted(disk_attr)
+        self.counters = sorted(set(metric for attr in disk_attr.values()
+                                   if attr['semantics'] != 'value'
+                                   for metric in (attr['metrics'] +
+                                                  attr.get('per', []))))
+        self.gauges = sorted(set(metric for attr in disk_attr.values()
+                                 if attr['semantics'] == 'value'
+                                 for metric in attr['metrics']))
+
+        # the metric used to establish the disk instances of each fetch
+        self.index_metric = (self.counters + self.gauges)[0]
+
+        # metric name -> True if it's a 32 bit type (that can wrap)
+        self.counter32 = {}
 
     def timeStampDelta(self, group):
         s = group.timestamp.tv_sec - group.prevTimestamp.tv_sec
@@ -102,132 +230,217 @@ class PCPbase(pmcc.MetricGroupPrinter):
         # u may be negative here, calculation is still correct.
         return s + u / 1000000.0
 
-    def instlist(self, group, name):
-        return dict(map(lambda x: (x[1], x[2]), group[name].netValues)).keys()
-
-    def curVals(self, group, name):
-        return dict(map(lambda x: (x[1], x[2]), group[name].netValues))
+    def sampleTime(self, group):
+        return group.timestamp.tv_sec + group.timestamp.tv_usec / 1000000.0
 
-    def prevVals(self, group, name):
-        return dict(map(lambda x: (x[1], x[2]), group[name].netPrevValues))
-
-    def get_cpu_and_network(self, group, dt):
+    def publish(self, group):
+        """
+        Commit the sample just extracted, tagging it with an epoch number
+        derived from the sample time, and notify any listeners
+        """
 
-        timestamp = group.contextCache.pmCtime(int(group.timestamp)).rstrip()
-        self.metrics.timestamp = timestamp
+        sample_time = self.sampleTime(group)
+        epoch = int(round(sample_time / self.metrics.interval))
 
-        nic_list = self.instlist(group, 'network.interface.in.bytes')
+        self.metrics.samples.commit(sample_time, epoch)
+        self.metrics.epoch = epoch
 
-        # NIC metrics
-        c_nic_in_b = self.curVals(group, 'network.interface.in.bytes')
-        p_nic_in_b = self.prevVals(group, 'network.interface.in.bytes')
-        c_nic_out_b = self.curVals(group, 'network.interface.out.bytes')
-        p_nic_out_b = self.prevVals(group, 'network.interface.out.bytes')
+        for listener in self.listeners:
+            listener(self.metrics)
 
-        tot_in = tot_out = 0
-        for nic in nic_list:
-            if nic in PCPDMextract.NIC_BLACKLIST:
-                continue
-            tot_in += (c_nic_in_b[nic] - p_nic_in_b[nic]) / dt
-            tot_out += (c_nic_out_b[nic] - p_nic_out_b[nic]) / dt
+    @staticmethod
+    def _aligned(values, inst_ids):
+        """
+        return the values of a metric in the sequence of the instance index.
+        pmcd normally returns every metric's instances in the same sequence,
+        so the values are only looked up by instance when the sequence
+        differs
+        :return: (list of values, True if every instance has a value).
+        Instances missing from the metric have a value of None
+        """
+        if values is None:
+            return [None] * len(inst_ids), False
+        if map(itemgetter(0), values) == inst_ids:
+            return map(itemgetter(2), values), True
+        lookup = dict((value[0], value[2]) for value in values)
+        return [lookup.get(inst_id) for inst_id in inst_ids], False
+
+    def deltas(self, group, names, index_metric=None):
+        """
+        Compute the counter deltas of a set of metrics, for every instance,
+        in a single pass. The instance index is built once per fetch from
+        the first metric (or index_metric)
+        :param group: metric group of the last fetch
+        :param names: metric names, sharing the same instance domain
+        :param index_metric: metric defining the instances
+        :return: (list of instance ids, list of instance names, dict of
+        metric name -> list of deltas in instance sequence). The delta is
+        None for an instance without a usable previous value (new since the
+        last fetch, or the counter has been reset)
+        """
 
-        self.metrics.nic_bytes = {'in': tot_in, 'out': tot_out}
+        current = group[index_metric or names[0]].netValues
+        inst_ids = map(itemgetter(0), current)
+        instances = map(itemgetter(1), current)
+
+        deltas = {}
+        for name in names:
+            metric = group[name]
+            if name not in self.counter32:
+                self.counter32[name] = (metric.desc.contents.type in
+                                        (PM_TYPE_32, PM_TYPE_U32))
+            counter32 = self.counter32[name]
+
+            cur_vals, cur_complete = self._aligned(metric.netValues, inst_ids)
+            prev_vals, prev_complete = self._aligned(metric.netPrevValues,
+                                                     inst_ids)
+
+            if cur_complete and prev_complete:
+                # the usual case - every instance in both samples
+                values = map(sub, cur_vals, prev_vals)
+                if values and min(values) < 0:
+                    values = [value if value >= 0
+                              else counter_delta(cur_vals[pos], prev_vals[pos],
+                                                 counter32)
+                              for pos, value in enumerate(values)]
+            else:
+                values = [counter_delta(cur, prev, counter32)
+                          for cur, prev in zip(cur_vals, prev_vals)]
+
+            deltas[name] = values
+
+        return inst_ids, instances, deltas
+
+    def attr_values(self, group, dt):
+        """
+        Derive the layout's disk attributes for every instance
+        :param group: metric group of the last fetch
+        :param dt: secs between the last two fetches
+        :return: (list of instance names, dict of attribute -> list of
+        values in instance sequence). A value is None when an instance
+        doesn't have the samples it needs
+        """
 
-        # CPU metrics
-        #
-        # get the number of cpu's on this host to calculate cpu utilisation
-        num_cpus = self.curVals(group, 'hinv.ncpu')['']
-        cpu_multiplier = self.metrics.interval * 1000
+        inst_ids, instances, deltas = self.deltas(group, self.counters,
+                                                  self.index_metric)
+        for metric in self.gauges:
+            deltas[metric] = self._aligned(group[metric].netValues,
+                                           inst_ids)[0]
+
+        values = {}
+        for attr_name in self.attrs:
+            attr = self.layout.disk_attr[attr_name]
+            total = sum_columns([deltas[metric]
+                                 for metric in attr['metrics']])
+
+            if attr['semantics'] == 'rate':
+                scale = attr.get('scale', 1) / dt
+                values[attr_name] = [value * scale if value is not None
+                                     else None
+                                     for value in total]
+            elif attr['semantics'] == 'ratio':
+                per = sum_columns([deltas[metric] for metric in attr['per']])
+                values[attr_name] = [(value / float(count) if count else 0.0)
+                                     if value is not None and count is not None
+                                     else None
+                                     for value, count in zip(total, per)]
+            else:
+                values[attr_name] = total
+
+        return instances, values
+
+    def lun_name(self, inst):
+        """ return the LUN name for a disk instance, or None to skip it """
+        return inst
+
+    def put_samples(self, group, dt, seen=None):
+        """
+        Write the disk attributes of every LUN to the sample being built
+        :param group: metric group of the last fetch
+        :param dt: secs between the last two fetches
+        :param seen: set of LUN names already written to the sample, which
+        are skipped (the names written are added to it)
+        """
 
-        c_k_sys = float(self.curVals(group, 'kernel.all.cpu.sys')[''])
-        p_k_sys = float(self.prevVals(group, 'kernel.all.cpu.sys')[''])
-        c_k_user = float(self.curVals(group, 'kernel.all.cpu.user')[''])
-        p_k_user = float(self.prevVals(group, 'kernel.all.cpu.user')[''])
-        c_k_intr = float(self.curVals(group, 'kernel.all.cpu.intr')[''])
-        p_k_intr = float(self.prevVals(group, 'kernel.all.cpu.intr')[''])
-
-        used = []
-        used.append(
-            100 * (float(c_k_sys - p_k_sys) / (num_cpus * cpu_multiplier)))
-        used.append(
-            100 * (float(c_k_user - p_k_user) / (num_cpus * cpu_multiplier)))
-        used.append(
-            100 * (float(c_k_intr - p_k_intr) / (num_cpus * cpu_multiplier)))
+        instances, values = self.attr_values(group, dt)
+        attrs = self.attrs
+        rows = zip(*[values[attr] for attr in attrs])
+        samples = self.metrics.samples
 
-        self.metrics.cpu_busy_pct = int(round(sum(used)))
+        for inst, pos in sorted(zip(instances, xrange(len(instances)))):
 
+            row_values = rows[pos]
+            if None in row_values:
+                # new instance (or reset counters), so there's no delta yet
+                continue
 
-class PCPLIOextract(PCPbase):
+            lun_name = self.lun_name(inst)
+            if lun_name is None:
+                continue
 
-    disk_attr = {
-                'iops': {'sum_method': 'sum'},
-                'read_mb': {'sum_method': 'sum'},
-                'write_mb': {'sum_method': 'sum'}
-                }
+            if seen is not None:
+                if lun_name in seen:
+                    continue
+                seen.add(lun_name)
 
-    def __init__(self, metrics):
-        PCPbase.__init__(self, metrics)
+            row = samples.add_row(lun_name)
+            for attr, value in zip(attrs, row_values):
+                samples.put(attr, row, value)
 
     def report(self, manager):
-        subtree = 'lio.lun'
-
-
         group = manager["gateways"]
 
-        # just use iops to get all disk instance names
-        lun_list = self.instlist(group, subtree + '.iops')
-
-        if group[subtree + '.iops'].netPrevValues is None:
+        if group[self.index_metric].netPrevValues is None:
             # need two fetches for the cur/prev deltas to work
             return
 
         dt = self.timeStampDelta(group)
         self.get_cpu_and_network(group, dt)
 
-        # LIO metrics originally extracted from
-        # /sys/kernel/config/target/iscsi/<iqn>/tpgt_<n>/lun/lun_<n>/statistics
-        c_iops = self.curVals(group, subtree + '.iops')
-        p_iops = self.prevVals(group, subtree + '.iops')
+        self.metrics.samples.begin()
+        self.put_samples(group, dt)
 
-        c_rmb = self.curVals(group, subtree + '.read_mb')
-        p_rmb = self.prevVals(group, subtree + '.read_mb')
+        self.publish(group)
 
-        c_wmb = self.curVals(group, subtree + '.write_mb')
-        p_wmb = self.prevVals(group, subtree + '.write_mb')
+    def get_cpu_and_network(self, group, dt):
 
-        # try:
-        for lun_name in sorted(lun_list):
+        timestamp = group.contextCache.pmCtime(int(group.timestamp)).rstrip()
+        self.metrics.timestamp = timestamp
+
+        # NIC metrics
+        _ids, nic_list, nic_deltas = self.deltas(group, NETWORK_METRICS)
 
-            if lun_name not in self.metrics.disk_stats:
-                self.metrics.disk_stats[lun_name] = DiskMetrics()
+        tot_in = tot_out = 0
+        for nic, bytes_in, bytes_out in zip(nic_list,
+                                            nic_deltas['network.interface.in.bytes'],
+                                            nic_deltas['network.interface.out.bytes']):
+            if nic in PCPbase.NIC_BLACKLIST:
+                continue
+            tot_in += (bytes_in or 0) / dt
+            tot_out += (bytes_out or 0) / dt
 
-            # self.metrics.disk_stats[key].dm_device = inst
-            self.metrics.disk_stats[lun_name].iops = (c_iops[lun_name] -
-                                                      p_iops[lun_name]) / dt
+        self.metrics.nic_bytes = {'in': tot_in, 'out': tot_out}
+
+        # CPU metrics
+        #
+        # get the number of cpu's on this host to calculate cpu utilisation
+        num_cpus = group['hinv.ncpu'].netValues[0][2]
+        cpu_multiplier = self.metrics.interval * 1000
 
-            self.metrics.disk_stats[lun_name].read_mb = (c_rmb[lun_name] -
-                                                         p_rmb[lun_name]) / dt
+        _ids, _inst, cpu_deltas = self.deltas(group, CPU_BUSY_METRICS)
 
-            self.metrics.disk_stats[lun_name].write_mb = (c_wmb[lun_name] -
-                                                          p_wmb[lun_name]) / dt
+        used = [100 * (float(cpu_deltas[name][0] or 0) /
+                       (num_cpus * cpu_multiplier))
+                for name in CPU_BUSY_METRICS]
 
-    @classmethod
-    def headers(cls, max_rbd_name):
-        return("{:<{}}    Src    Size     iops     rMB/s     wMB/s"
-               "   Client".format("Pool.Image",
-                                  max_rbd_name))
+        self.metrics.cpu_busy_pct = int(round(sum(used)))
 
-    @classmethod
-    def print_device_data(cls, devname, max_dev_name, disk_data, client):
 
-        return('{:<{}}    {:^3}    {:>4}    {:>5}    {:>6.2f}    '
-               '{:>6.2f}   {:<20}'.format(devname, max_dev_name,
-                                          disk_data.io_source,
-                                          bytes2human(disk_data.disk_size),
-                                          int(round(disk_data.tot_iops)),
-                                          disk_data.tot_read_mb,
-                                          disk_data.tot_write_mb,
-                                          client))
+class PCPLIOextract(PCPbase):
+    """
+    Extract the LUN metrics provided by the lio pmda. The instances are
+    the LUN names
+    """
 
 
 class PCPDMextract(PCPbase):
@@ -238,129 +451,80 @@ class PCPDMextract(PCPbase):
 
     device_regex = '[0-255]-[a-f,0-9]+'
 
-    disk_attr = {
-        'iops': {'sum_method': 'sum'},
-        'reads': {'sum_method': 'sum'},
-        'writes': {'sum_method': 'sum'},
-        'readkb': {'sum_method': 'sum'},
-        'writekb': {'sum_method': 'sum'},
-        'await': {'sum_method': 'max'},
-        'r_await': {'sum_method': 'max'},
-        'w_await': {'sum_method': 'max'}
-        }
-
-    def __init__(self, metrics):
-        PCPbase.__init__(self, metrics)
-        self.rbds = RBDMap()
-
-    @classmethod
-    def headers(cls, max_rbd_name):
-        return("{:<{}}  Src  Device   Size     r/s     w/s    rMB/s     wMB/s"
-               "    await  r_await  w_await  Client".format("Pool.Image",
-                                                            max_rbd_name))
-
-    @classmethod
-    def print_device_data(cls, devname, max_rbd_name, disk_data, client):
-
-        return("{:<{}}  {:^3}  {:^6}   {:>4}   {:>5}   {:>5}   {:>6.2f}    "
-               "{:>6.2f}   {:>6.2f}   {:>6.2f}"
-               "   {:>6.2f}  {:<20}".format(devname, max_rbd_name,
-                                            disk_data.io_source,
-                                            disk_data.rbd_name,
-                                            bytes2human(disk_data.disk_size),
-                                            int(disk_data.tot_reads),
-                                            int(disk_data.tot_writes),
-                                            disk_data.tot_readkb / 1024,
-                                            disk_data.tot_writekb / 1024,
-                                            disk_data.max_await,
-                                            disk_data.max_r_await,
-                                            disk_data.max_w_await,
-                                            client))
+    def __init__(self, metrics, layout, rbd_required=True):
+        """
+        :param rbd_required: raise CollectorError if there are no rbd dm
+        devices on this host
+        """
+        PCPbase.__init__(self, metrics, layout)
+        self.device_match = re.compile(PCPDMextract.device_regex).search
 
+        # the dm devices in an archive may not be mapped on this host
+        self.rbds = RBDMap(required=rbd_required and not metrics.archive)
 
-    def report(self, manager):
-        subtree = 'disk.dm'
+    def lun_name(self, inst):
+        """
+        rbd device mapped for the gateway use the following naming convention
+        <pool_id>.<rbd uid>. The pool/image name is taken from the lookup
+        table; dm devices that aren't rbd images we can resolve (e.g.
+        unmapped since pmcd was sampled) are skipped
+        """
 
-        # print "DEBUG - in report function"
+        if self.device_match(inst) is None:
+            return None
 
-        group = manager["gateways"]
+        rbd = self.rbds.lookup(inst)
+        if rbd is not None:
+            return rbd['rbd_name']
+        if self.metrics.archive:
+            # archived dm devices that aren't mapped on this host are
+            # shown by their dm name
+            return inst
+        return None
 
-        # just use reads to get all disk instance names
-        all_disks = self.instlist(group, subtree + '.read')
 
-        # rbd device mapped for the gateway use the following naming convention
-        # <pool_id>.<rbd uid>
-        instlist = [disk_id for disk_id in all_disks
-                    if re.search(PCPDMextract.device_regex, disk_id) is not None]
-        # print "DEBUG - devices found %s " % instlist
+class PCPCombinedextract(PCPbase):
+    """
+    Extract the LUN metrics from both the dm and lio providers in the same
+    fetch, for gateways with both krbd/device-mapper and user (TCMU)
+    backed LUNs. Each provider's instances are extracted with the
+    attributes the layout defines for the provider, and merged into a
+    single sample by LUN name. A LUN seen by both providers takes the dm
+    values, since they include the latency
+    """
+
+    def __init__(self, metrics, layout):
+        PCPbase.__init__(self, metrics, layout)
+
+        # hosts in a mixed estate may not have any dm devices yet
+        self.extractors = [PCPDMextract(metrics,
+                                        layout.provider_layout('dm'),
+                                        rbd_required=False),
+                           PCPLIOextract(metrics,
+                                         layout.provider_layout('lio'))]
+
+    def report(self, manager):
+        group = manager["gateways"]
 
-        if group[subtree + '.read'].netPrevValues is None:
+        if group[self.index_metric].netPrevValues is None:
             # need two fetches for the cur/prev deltas to work
             return
 
         dt = self.timeStampDelta(group)
         self.get_cpu_and_network(group, dt)
 
-        # dm metrics
-        c_r = self.curVals(group, subtree + '.read')
-        p_r = self.prevVals(group, subtree + '.read')
-
-        c_w = self.curVals(group, subtree + '.write')
-        p_w = self.prevVals(group, subtree + '.write')
-
-        c_rkb = self.curVals(group, subtree + '.read_bytes')
-        p_rkb = self.prevVals(group, subtree + '.read_bytes')
-
-        c_wkb = self.curVals(group, subtree + '.write_bytes')
-        p_wkb = self.prevVals(group, subtree + '.write_bytes')
-
-        c_ractive = self.curVals(group, subtree + '.read_rawactive')
-        p_ractive = self.prevVals(group, subtree + '.read_rawactive')
-
-        c_wactive = self.curVals(group, subtree + '.write_rawactive')
-        p_wactive = self.prevVals(group, subtree + '.write_rawactive')
-
-        # try:
-        for inst in sorted(instlist):
-
-            try:
-                # get pool/image name for the dm name from the lookup table
-                key = self.rbds.map[inst]['rbd_name']
-            except KeyError:
-                self.rbds.refresh()
-                if inst in self.rbds.map:
-                    key = self.rbds.map[inst]['rbd_name']
-                else:
-                    raise CollectorError("PCPExtract: Unable to convert "
-                                         "{} to a pool/image name".format(inst))
-
-            if key not in self.metrics.disk_stats:
-                self.metrics.disk_stats[key] = DiskMetrics()
+        self.metrics.samples.begin()
+        seen = set()
+        for extractor in self.extractors:
+            extractor.put_samples(group, dt, seen)
 
-            # self.metrics.disk_stats[key].dm_device = inst
-            self.metrics.disk_stats[key].reads = (c_r[inst] - p_r[inst]) / dt
+        self.publish(group)
 
-            self.metrics.disk_stats[key].writes = (c_w[inst] - p_w[inst]) / dt
 
-            self.metrics.disk_stats[key].iops = self.metrics.disk_stats[key].reads + \
-                                                self.metrics.disk_stats[key].writes
-
-            self.metrics.disk_stats[key].readkb = (c_rkb[inst] - p_rkb[inst]) / dt
-            self.metrics.disk_stats[key].writekb = (c_wkb[inst] - p_wkb[inst]) / dt
-
-            tot_rios = (float)(c_r[inst] - p_r[inst])
-            tot_wios = (float)(c_w[inst] - p_w[inst])
-            tot_ios = (float)(tot_rios + tot_wios)
-
-            self.metrics.disk_stats[key].await = (((c_ractive[inst] - p_ractive[inst]) +
-                                                   (c_wactive[inst] - p_wactive[inst]))
-                                                  / tot_ios) if tot_ios else 0.0
-
-            self.metrics.disk_stats[key].r_await = ((c_ractive[inst] - p_ractive[inst])
-                                                    / tot_rios) if tot_rios else 0.0
-
-            self.metrics.disk_stats[key].w_await = ((c_wactive[inst] - p_wactive[inst])
-                                                    / tot_wios) if tot_wios else 0.0
+# registered metric extractors, by pcp provider
+EXTRACTORS = {'dm': PCPDMextract,
+              'lio': PCPLIOextract,
+              'combined': PCPCombinedextract}
 
 
 class PCPcollector(threading.Thread):
@@ -370,51 +534,177 @@ class PCPcollector(threading.Thread):
     """
 
     def __init__(self, logger, sync_event, host='', interval='1',
-                 pcp_type='dm'):
+                 pcp_type='dm', devices=None, history=SAMPLE_HISTORY,
+                 profiler=None, archive=None, start=None, finish=None,
+                 layout=None):
 
         threading.Thread.__init__(self)
         self.hostname = host
         self.start_me_up = sync_event
         self.logger = logger
+        self.profiler = profiler or Profiler()
 
-        collector_lookup = {'dm': PCPDMextract,
-                            'lio': PCPLIOextract}
+        # the layout defines the disk attributes to collect and summarise,
+        # and the pcp metrics they need
+        layout = layout or layout_lookup[pcp_type]
 
         opts = IOstatOptions(host)
         self.context = None
 
         # The manager object builds it's options from the command line
-        # parameters, so we simulate that with a list
-        args_list = ['', '-h', host, '-t', str(interval)]
+        # parameters, so we simulate that with a list. Archives are read
+        # with the samples aligned to the interval, so the samples from each
+        # gateway's archive share the same epochs
+        if archive:
+            args_list = ['', '-a', archive, '-t', str(interval),
+                         '-A', str(interval)]
+            if start:
+                args_list += ['-S', start]
+            if finish:
+                args_list += ['-T', finish]
+        else:
+            args_list = ['', '-h', host, '-t', str(interval)]
+
         try:
             self.manager = pmcc.MetricGroupManager.builder(opts, args_list)
-            self.manager["gateways"] = (DISK_METRICS[pcp_type] +
+            if archive and not host:
+                self.hostname = host = self.archive_host(archive)
+            self.manager["gateways"] = (layout.pcp_metrics() +
                                         CPU_METRICS +
                                         NETWORK_METRICS)
             self.metrics = GatewayMetrics()
             self.metrics.cpu_busy_pct = 0
             self.metrics.cpu_idle_pct = 0
             self.metrics.interval = interval
+            self.metrics.hostname = host
+            self.metrics.epoch = -1
             self.metrics.timestamp = None
-            self.metrics.disk_stats = {}
             self.metrics.nic_bytes = {'in': 0, 'out': 0}
+            self.metrics.archive = archive
+
+            self.disk_attr = layout.disk_attr
 
-            # set up the disk attributes to collect and summarise based on the
-            # provider type
-            collector = collector_lookup[pcp_type]
-            self.disk_attr = collector.disk_attr
-            self.collector = collector
+            # disk metrics are held in a ring buffer, with the rows seeded
+            # from the device list so every collector uses the same LUN
+            # sequence
+            self.metrics.samples = SampleRing(sorted(layout.disk_attr),
+                                              sorted(devices or []),
+                                              capacity=history)
+            self.collector = layout
 
-            self.manager.printer = collector(self.metrics)
+            self.manager.printer = EXTRACTORS[pcp_type](self.metrics, layout)
 
             self.connected = True
         except pmapi.pmErr:
             self.connected = False
 
+    def add_listener(self, listener):
+        """
+        Register a callable to be called with the collector's metrics each
+        time a sample is published
+        """
+        self.manager.printer.listeners.append(listener)
+
+    def archive_host(self, archive):
+        """ return the name of the host an archive was recorded on """
+        try:
+            return self.manager.pmGetArchiveLabel().get_hostname().split('.')[0]
+        except (pmapi.pmErr, AttributeError):
+            return os.path.basename(archive)
+
+    def fetch(self):
+        """
+        Fetch the metric group from pmcd, without extracting the sample
+        :return: the collector, or None if the fetch failed
+        """
+        start = monotonic()
+        try:
+            self.manager.fetch()
+        except pmapi.pmErr as err:
+            self.logger.debug("pmcd fetch from {} failed : "
+                              "{}".format(self.hostname, err))
+            return None
+        finally:
+            self.profiler.record('fetch:{}'.format(self.hostname),
+                                 monotonic() - start)
+        return self
+
+    def extract(self):
+        """ extract and publish the sample from the last fetch """
+        start = monotonic()
+        self.manager.printer.report(self.manager)
+        self.profiler.record('extract:{}'.format(self.hostname),
+                             monotonic() - start)
+
     def run(self):
         # grab the data and store in dict every second
         self.logger.debug("pcp manager thread started for "
                           "host {}".format(self.hostname))
 
+        if self.metrics.archive:
+            # archives are read as fast as the listeners consume the
+            # samples, rather than at the sample interval, until the end of
+            # the archive (or the finish time) is reached
+            self.start_me_up.wait()
+            while self.fetch():
+                self.extract()
+            self.logger.debug("end of archive reached for "
+                              "host {}".format(self.hostname))
+            return
+
+        if self.profiler.enabled:
+            # time the fetch and extract calls made by the pmcc run loop
+            self.manager.fetch = self.profiler.wrap(
+                'fetch:{}'.format(self.hostname), self.manager.fetch)
+            self.manager.printer.report = self.profiler.wrap(
+                'extract:{}'.format(self.hostname), self.manager.printer.report)
+
         self.start_me_up.wait()
         self.manager.run()
+
+
+def _fetch_collector(collector):
+    return collector.fetch()
+
+
+class PCPengine(threading.Thread):
+    """
+    Single scheduler thread that drives the pmcd fetches for every
+    collector. All fetches are issued together on the interval boundary, and
+    each collector's sample is extracted by this thread as soon as its fetch
+    completes, so the gateways are sampled at the same time
+    """
+
+    def __init__(self, logger, sync_event, collectors, interval=1):
+
+        threading.Thread.__init__(self)
+        self.logger = logger
+        self.start_me_up = sync_event
+        self.collectors = collectors
+        self.interval = interval
+
+        # the pool only waits on the (blocking) pmFetch calls
+        self.pool = ThreadPool(len(collectors))
+
+    def run(self):
+        self.logger.debug("pcp scheduler thread started for {} "
+                          "host(s)".format(len(self.collectors)))
+
+        self.start_me_up.wait()
+
+        next_tick = time.time()
+        while True:
+
+            for collector in self.pool.imap_unordered(_fetch_collector,
+                                                      self.collectors):
+                if collector is not None:
+                    collector.extract()
+
+            # sleep until the next interval boundary, skipping any that
+            # have already been missed
+            now = time.time()
+            next_tick += self.interval
+            if next_tick < now:
+                next_tick = now + self.interval - ((now - next_tick) %
+                                                   self.interval)
+            time.sleep(next_tick - now)
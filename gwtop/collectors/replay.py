@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import threading
+import time
+
+from gwtop.collectors.layout import layout_lookup
+from gwtop.config.generic import Config, GatewayMetrics
+from gwtop.utils.samples import SampleRing, SAMPLE_HISTORY
+from gwtop.utils.profiler import monotonic
+
+
+class ReplayCollector(object):
+    """
+    Stand-in for a PCPcollector, holding the samples replayed for a gateway
+    from a recording
+    """
+
+    def __init__(self, logger, host, interval, pcp_type, devices,
+                 history=SAMPLE_HISTORY, layout=None):
+
+        self.hostname = host
+        self.logger = logger
+        self.listeners = []
+
+        self.collector = layout or layout_lookup[pcp_type]
+        self.disk_attr = self.collector.disk_attr
+
+        self.metrics = GatewayMetrics()
+        self.metrics.cpu_busy_pct = 0
+        self.metrics.interval = interval
+        self.metrics.hostname = host
+        self.metrics.epoch = -1
+        self.metrics.timestamp = None
+        self.metrics.nic_bytes = {'in': 0, 'out': 0}
+        self.metrics.samples = SampleRing(sorted(self.disk_attr),
+                                          sorted(devices),
+                                          capacity=history)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def load(self, sample, luns, metrics):
+        """
+        Load a sample from the recording into the sample ring, and publish it
+        :param sample: sample tuple from RecordingReader.samples
+        :param luns: LUN dictionary of the recording
+        :param metrics: metric names of the recording, in row order
+        """
+
+        (gw_idx, timestamp, epoch, cpu, nic_in, nic_out,
+         lun_ids, values) = sample
+
+        samples = self.metrics.samples
+        samples.begin()
+
+        # metrics in the recording that the layout doesn't use are ignored
+        num_metrics = len(metrics)
+        offsets = [(offset, metric) for offset, metric in enumerate(metrics)
+                   if metric in self.disk_attr]
+        for lun_num, lun_id in enumerate(lun_ids):
+            row = samples.add_row(luns[lun_id]['name'])
+            base = lun_num * num_metrics
+            for offset, metric in offsets:
+                samples.put(metric, row, values[base + offset])
+
+        samples.commit(timestamp, epoch)
+
+        self.metrics.cpu_busy_pct = cpu
+        self.metrics.nic_bytes = {'in': nic_in, 'out': nic_out}
+        self.metrics.epoch = epoch
+
+        for listener in self.listeners:
+            listener(self.metrics)
+
+
+class Replayer(threading.Thread):
+    """
+    Feed the samples from a recording to the replay collectors, either
+    paced relative to the original sample times or as fast as the consumer
+    takes them (speed=0)
+    """
+
+    def __init__(self, logger, reader, config, collectors, speed=1.0):
+
+        threading.Thread.__init__(self)
+        self.logger = logger
+        self.reader = reader
+        self.config = config
+        self.collectors = collectors
+        self.speed = speed
+
+    def run(self):
+
+        barrier = self.config.barrier
+        reader = self.reader
+
+        current_epoch = None
+        start_time = start_wall = None
+        num_luns = len(reader.luns)
+
+        for sample in reader.samples():
+
+            epoch = sample[2]
+            if epoch != current_epoch:
+                if current_epoch is not None and not self.speed:
+                    # don't run ahead of the consumer at maximum speed
+                    barrier.wait_released(current_epoch)
+
+                current_epoch = epoch
+                timestamp = sample[1]
+                if start_time is None:
+                    start_time, start_wall = timestamp, time.time()
+                elif self.speed:
+                    delay = (start_wall +
+                             (timestamp - start_time) / self.speed -
+                             time.time())
+                    if delay > 0:
+                        time.sleep(delay)
+
+            if len(reader.luns) != num_luns:
+                # the recording has defined new LUNs. The device map is
+                # replaced rather than updated, since the summarize and
+                # display threads iterate over it
+                devices = dict(self.config.devices)
+                for lun in reader.luns[num_luns:]:
+                    devices[lun['name']] = {"size": lun['size'],
+                                            "rbd_name": lun['rbd_name']}
+                self.config.devices = devices
+                self.config.device_generation += 1
+                num_luns = len(reader.luns)
+
+            collector = self.collectors[sample[0]]
+            start = monotonic()
+            collector.load(sample, reader.luns, reader.metrics)
+            self.config.profiler.record('extract:{}'.format(collector.hostname),
+                                        monotonic() - start)
+
+        if current_epoch is not None:
+            barrier.wait_released(current_epoch)
+
+        self.logger.debug("replay complete")
+        barrier.close()
+
+
+def get_replay_gateway(reader):
+    """
+    Return a gateway config object for a recording, standing in for the
+    GatewayConfig from the LIO configuration
+    """
+
+    gateway_config = Config()
+    gateway_config.gateways = reader.gateways
+    gateway_config.diskmap = reader.header.get('clients', {})
+    gateway_config.client_count = reader.header.get('client_count', 0)
+    gateway_config.error = False
+
+    return gateway_config
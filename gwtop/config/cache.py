@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import glob
+import hashlib
+import json
+import os
+import threading
+
+CACHE_VERSION = 1
+CACHE_FILE = os.path.expanduser('~/.cache/gwtop/devices.json')
+
+# configfs directories whose mtimes change when storage objects or LUNs are
+# added or removed
+CONFIGFS_DIRS = ['/sys/kernel/config/target/core',
+                 '/sys/kernel/config/target/core/*',
+                 '/sys/kernel/config/target/iscsi/*/tpgt_*/lun']
+
+
+def configfs_fingerprint():
+    """
+    Return a cheap fingerprint of the LIO configuration, based on the
+    mtimes of the configfs directories holding the storage objects and LUNs
+    :return: str
+    """
+
+    state = []
+    for pattern in CONFIGFS_DIRS:
+        for path in sorted(glob.glob(pattern)):
+            try:
+                state.append((path, os.stat(path).st_mtime))
+            except OSError:
+                # removed since the glob
+                continue
+
+    return hashlib.sha1(json.dumps(state)).hexdigest()
+
+
+def load_device_map(cache_file=CACHE_FILE):
+    """
+    Read the cached device map
+    :param cache_file: path to the cache
+    :return: (fingerprint, device map) or (None, None) if there is no usable
+    cache
+    """
+
+    try:
+        with open(cache_file) as cache:
+            content = json.load(cache)
+    except (IOError, ValueError):
+        return None, None
+
+    if not isinstance(content, dict) or \
+            content.get('version') != CACHE_VERSION:
+        return None, None
+
+    return content.get('fingerprint'), content.get('devices')
+
+
+def save_device_map(fingerprint, device_map, cache_file=CACHE_FILE):
+    """
+    Write the device map to the cache. The cache is only an optimisation, so
+    failures are ignored
+    :param fingerprint: configfs fingerprint the device map was built from
+    :param device_map: dict of devices
+    :param cache_file: path to the cache
+    """
+
+    tmp_file = '{}.{}'.format(cache_file, os.getpid())
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        with open(tmp_file, 'w') as cache:
+            json.dump({"version": CACHE_VERSION,
+                       "fingerprint": fingerprint,
+                       "devices": device_map}, cache)
+
+        # replace the cache in one step, so readers never see a partial file
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def get_cached_device_map(loader, cache_file=CACHE_FILE):
+    """
+    Return the device map from the cache when the configfs fingerprint is
+    unchanged. Otherwise a stale cache is still returned, so monitoring can
+    start immediately, and the caller should refresh it in the background.
+    Without a cache, the device map is built by the loader
+    :param loader: function returning the device map from LIO
+    :param cache_file: path to the cache
+    :return: (device map, fingerprint, stale flag)
+    """
+
+    fingerprint = configfs_fingerprint()
+    cached_fingerprint, device_map = load_device_map(cache_file)
+
+    if device_map:
+        return device_map, fingerprint, cached_fingerprint != fingerprint
+
+    device_map = loader()
+    save_device_map(fingerprint, device_map, cache_file)
+    return device_map, fingerprint, False
+
+
+class DeviceMapRefresher(threading.Thread):
+    """
+    Rebuild a stale device map in the background. Once loaded, the device
+    map replaces config.devices and the config.device_generation counter is
+    bumped, so the summary/device filter pick up the new LUNs
+    """
+
+    def __init__(self, logger, config, loader, fingerprint,
+                 cache_file=CACHE_FILE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.config = config
+        self.loader = loader
+        self.fingerprint = fingerprint
+        self.cache_file = cache_file
+
+    def run(self):
+
+        device_map = self.loader()
+
+        save_device_map(self.fingerprint, device_map, self.cache_file)
+
+        self.config.devices = device_map
+        self.config.device_generation += 1
+
+        self.logger.debug("Device map refreshed, {} "
+                          "LUNs".format(len(device_map)))
@@ -2,40 +2,106 @@
 
 __author__ = 'paul'
 
+import threading
 import rados
 import json
 
-import rados
-import json
 
-class CephCluster(object):
+class CephCluster(threading.Thread):
+    """
+    Track the health and OSD count of the ceph cluster. A single rados
+    handle is kept open for the life of the object (and re-opened if the
+    connection fails), and only the health and osd stat queries are issued,
+    each with a timeout. An object of this class runs as a daemon thread,
+    so a slow monitor never delays the UI
+    """
 
     conf = '/etc/ceph/ceph.conf'
     keyring = '/etc/ceph/ceph.client.admin.keyring'
 
-    def __init__(self, conf=conf, keyring=keyring):
+    def __init__(self, conf=conf, keyring=keyring, interval=30, timeout=5):
+        threading.Thread.__init__(self)
+        self.daemon = True
         self.conf = conf
         self.keyring = keyring
-        self.status = {}
+        self.interval = interval
+        self.timeout = timeout
+
+        self.cluster = None
+        self.health_state = {}
+        self.osd_state = {}
+        self.shutdown = threading.Event()
+
+    def connect(self):
+        """ open the rados handle, if it isn't already """
+
+        if self.cluster is not None:
+            return
+
+        cluster = rados.Rados(conffile=self.conf,
+                              conf=dict(keyring=self.keyring))
+        try:
+            cluster.connect(timeout=self.timeout)
+        except rados.Error:
+            cluster.shutdown()
+            raise
+
+        self.cluster = cluster
+
+    def disconnect(self):
+        if self.cluster is not None:
+            self.cluster.shutdown()
+            self.cluster = None
+
+    def mon_command(self, prefix):
+        """
+        Issue a mon command, returning the json response as a dict
+        :param prefix: command e.g. 'health'
+        :return: dict
+        """
+
+        cmd = {'prefix': prefix, 'format': 'json'}
+        ret, buf_s, out = self.cluster.mon_command(json.dumps(cmd), b'',
+                                                   timeout=self.timeout)
+        if ret != 0:
+            raise rados.Error("{} failed : {}".format(prefix, out))
+
+        return json.loads(buf_s)
 
     def update_state(self):
+        """
+        Refresh the health and osd state. On any failure the state is
+        cleared and the handle dropped, so the next update reconnects
+        """
+
+        try:
+            self.connect()
+            self.health_state = self.mon_command('health')
+            self.osd_state = self.mon_command('osd stat')
+        except (rados.Error, ValueError):
+            self.health_state = {}
+            self.osd_state = {}
+            self.disconnect()
+
+    def run(self):
+        while not self.shutdown.is_set():
+            self.update_state()
+            self.shutdown.wait(self.interval)
 
-        with rados.Rados(conffile=self.conf, conf=dict(keyring=self.keyring)) as cluster:
-            cmd = {'prefix': 'status', 'format': 'json'}
-            ret, buf_s, out = cluster.mon_command(json.dumps(cmd), b'')
+        self.disconnect()
 
-        self.status = json.loads(buf_s)
+    def stop(self):
+        self.shutdown.set()
 
     def _get_health(self):
-        if 'health' not in self.status:
-            return ''
-        if self.status['health'].has_key('status'):
-            return self.status['health']['status']
-        else:
-            return self.status['health']['overall_status']
+        if 'status' in self.health_state:
+            return self.health_state['status']
+        return self.health_state.get('overall_status', '')
 
     def _get_osds(self):
-        return self.status['osdmap']['osdmap']['num_osds'] if 'osdmap' in self.status else ''
+        # older releases nest the counts under osdmap
+        osd_stat = self.osd_state.get('osdmap', self.osd_state)
+        return osd_stat.get('num_osds', '')
 
     health = property(_get_health,
                       doc="Get overall health of the ceph cluster")
@@ -25,12 +25,6 @@ class Config(object):
         return str(self.__dict__)
 
 
-class DiskMetrics(Config):
-    """
-    Simple object used to to hold disk metrics
-    """
-
-
 class GatewayMetrics(Config):
     """
     Simple config object
@@ -47,6 +41,14 @@ class HostSummary(object):
         self.net_in = []
         self.net_out = []
         self.timestamp = ''
+        self.sample_time = None     # secs since the epoch
+        self.missing = []       # gateways without data for this epoch
+        self.partial = False
+        self.rates = {}         # gateway -> smoothed cpu/network values
+        self.gateways = []      # gateways in the sample, in matrix order
+        self.lun_matrix = {}    # attr -> per gateway columns of LUN values
+        self.lun_index = {}     # LUN name -> position in a matrix column
+        self.gateway_totals = {}    # gateway -> rolled up LUN values
         self.total_capacity = 0
         self.total_iops = 0
 
@@ -56,20 +58,18 @@ class HostSummary(object):
 
 class DiskSummary(object):
     """
-    Generic class defining disk summary attributes
+    Generic class defining disk summary attributes. The rolled up metrics
+    (tot_<attr> or max_<attr>), and the smoothed values in use (<attr>_ewma,
+    <attr>_1m etc) are added by the summarize function based on the
+    collector's disk attributes
     """
 
-    def __init__(self):
-        self.iops = []
-        self.reads = []
-        self.writes = []
-        self.readkb = []
-        self.writekb = []
-        self.await = []
-        self.r_await = []
-        self.w_await = []
-        self.read_mb = []
-        self.write_mb = []
+    def __init__(self, disk_size=0, rbd_name='', io_source='',
+                 collector=None):
+        self.disk_size = disk_size
+        self.rbd_name = rbd_name
+        self.io_source = io_source
+        self.collector = collector
 
     def __repr__(self):
         return str(self.__dict__)
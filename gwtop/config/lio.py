@@ -5,6 +5,8 @@ import subprocess
 import json
 import rados
 import os
+import threading
+import time
 
 from rtslib_fb import root
 
@@ -33,6 +35,21 @@ def add_rbd_maps(devices):
                                                            rbd_dict[key]['name'])
 
 
+def tpg_lun_path(mapped_lun):
+    """
+    return the configfs path of the tpg lun a mapped lun points to
+    :param mapped_lun: rtslib MappedLUN object
+    :return: path or None
+    """
+
+    for entry in os.listdir(mapped_lun.path):
+        link = os.path.join(mapped_lun.path, entry)
+        if os.path.islink(link):
+            return os.path.realpath(link)
+
+    return None
+
+
 class GatewayConfig(object):
     """
     Configuration class representing the local LIO configuration, based on the
@@ -79,22 +96,39 @@ class GatewayConfig(object):
 
 
 
+        self.client_count = 0   # number of clients defined
+
         if not self.error:
-            self.diskmap = self._get_mapped_disks()
+            self.refresh()
+
+    def refresh(self):
+        """
+        Take a new snapshot of the LIO client configuration. The UI only
+        reads the snapshot, so configfs is walked once per refresh rather
+        than each time the display is updated
+        """
+
+        lio_root = root.RTSRoot()
+        diskmap = self._get_mapped_disks(lio_root)
+        client_count = len(list(lio_root.node_acls))
+
+        # swap in the new snapshot
+        self.diskmap = diskmap
+        self.client_count = client_count
 
-    def _get_mapped_disks(self):
+    def _get_mapped_disks(self, lio_root):
         '''
-        return a dict indexed by a pool/image name that points to the client
-        that has this device mapped to it. If the client mapped is currently
+        return a dict indexed by a pool/image name that lists the clients
+        that have this device mapped to them. If a client is currently
         connected the name used is the alias (dns) of the client from LIO
         session information - if not, we just use the last qualifier of the
-        iqn
-        :return: dict <pool>.<image> --> <client_name> | '- multi -'
+        iqn. The tpg luns are indexed by their configfs path in a single
+        pass, so each client mapping is resolved with one readlink
+        :param lio_root: rtslib RTSRoot object
+        :return: dict <pool>.<image> --> [<client_name>, ...]
         '''
 
         map = {}
-        pools = {}
-        lio_root = root.RTSRoot()
 
         # get a list of active sessions on this host indexed by the iqn
         connections = {}
@@ -105,41 +139,56 @@ class GatewayConfig(object):
 
         # seed the map dict with an entry for each storage object
         for so in lio_root.storage_objects:
-            map[so.name] = ''
+            map[so.name] = []
+
+        # tpg lun path -> storage object name
+        lun_index = {}
+        for lun in lio_root.luns:
+            lun_index[os.path.realpath(lun.path)] = lun.storage_object.name
 
         # process each client
         for node in lio_root.node_acls:
 
-            # for each client, look at it's luns
-            for m_lun in node.mapped_luns:
+            # if this node is connected, try and use it's alias
+            short_name = node.node_wwn.split(':')[-1]
+            if node.node_wwn in connections:
+                alias_name = connections[node.node_wwn]["alias"]
+                client_name = "{}(CON)".format(alias_name or short_name)
+            else:
+                client_name = short_name
 
-                tpg_lun = m_lun._get_tpg_lun()
-                disk_name = tpg_lun.storage_object.name
-
-                if map[disk_name]:
-                    map[disk_name] = '- multi -'
-                else:
-                    # if this node is connected, try and use it's alias
-                    if node.node_wwn in connections:
-                        suffix = "(CON)"
-                        alias_name = connections[node.node_wwn]["alias"]
-                        if alias_name:
-                            map[disk_name] = "{}(CON)".format(alias_name)
-                        else:
-                            map[disk_name] = "{}(CON)".format(node.node_wwn.split(':')[-1])
-                    else:
-                        map[disk_name] = "{}".format(node.node_wwn.split(':')[-1])
+            # for each client, look at it's luns. A client reaches a LUN
+            # through the tpg of each gateway, but is only listed once
+            for m_lun in node.mapped_luns:
+                disk_name = lun_index.get(tpg_lun_path(m_lun))
+                if disk_name in map and client_name not in map[disk_name]:
+                    map[disk_name].append(client_name)
 
         return map
 
-    def _get_client_count(self):
-        r = root.RTSRoot()
-        nodeACL_list = [client.node_wwn
-                        for client in r.node_acls]
-        return len(nodeACL_list)
 
-    client_count = property(_get_client_count,
-                           doc="return the number of clients defined")
+class LIORefresher(threading.Thread):
+    """
+    Refresh the LIO client snapshot held by a GatewayConfig object at a
+    regular interval, so client and session changes are reflected in the UI
+    """
+
+    def __init__(self, logger, gateway_config, interval=10):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.logger = logger
+        self.gateway_config = gateway_config
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.gateway_config.refresh()
+            except Exception as err:
+                # configfs changing under us, try again next time
+                self.logger.debug("LIO refresh failed : {}".format(err))
+
 
 def get_gateway_info(opts):
 
@@ -91,6 +91,11 @@ def get_lio_devices():
     # multiple tpgs - so we look out for that
     for lun in lio_root.luns:
 
+        # Each image name is assumed to be unique, so skip the lookups for a
+        # storage object already seen through another tpg
+        if lun.storage_object.name in device_data:
+            continue
+
         # plugin will show user or block
         lun_type = lun.storage_object.plugin
 
@@ -130,16 +135,13 @@ def get_lio_devices():
         image_size = lun.storage_object.size
         wwn = lun.storage_object.wwn
 
-        # Each image name is assumed to be unique
-        if image_name not in device_data:
-
-            device_data[image_name] = {"size": image_size,
-                                       "wwn": wwn,
-                                       "rbd_name": rbd_name,
-                                       "pool": pool_name,
-                                       "image_name": image_name,
-                                       "stg_type": storage_type,
-                                       "lun_type": lun_type}
+        device_data[image_name] = {"size": image_size,
+                                   "wwn": wwn,
+                                   "rbd_name": rbd_name,
+                                   "pool": pool_name,
+                                   "image_name": image_name,
+                                   "stg_type": storage_type,
+                                   "lun_type": lun_type}
 
     return device_data
 
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import threading
+import time
+
+
+class EpochBarrier(object):
+    """
+    Aligns the samples published by the collector threads. Each collector
+    publishes the epoch (sample sequence number) of every sample it
+    completes, and the consumer waits until all collectors have reached the
+    newest epoch - or until a deadline passes, in which case the epoch is
+    released with whatever gateways have reached it
+    """
+
+    def __init__(self, members=None, timeout=1.0, interval=1):
+        """
+        :param members: list of member (gateway) names
+        :param timeout: secs to wait for the slowest member once any member
+        has published a new epoch
+        :param interval: sample interval (secs)
+        """
+
+        self.cond = threading.Condition()
+        self.timeout = timeout
+        self.interval = interval
+        self.epochs = dict((member, -1) for member in (members or []))
+        self.first_seen = {}        # epoch -> time the epoch first appeared
+        self.released = -1
+        self.closed = False
+
+    def add_member(self, member):
+        """ add a member (gateway) to the barrier """
+        with self.cond:
+            self.epochs[member] = -1
+
+    def update(self, metrics):
+        """ listener entry point for the collectors' published samples """
+        self.publish(metrics.hostname, metrics.epoch)
+
+    def publish(self, member, epoch):
+        """
+        Record that a member has completed a sample
+        :param member: member (gateway) name
+        :param epoch: epoch of the completed sample
+        """
+
+        with self.cond:
+            if epoch > self._newest():
+                self.first_seen[epoch] = time.time()
+            self.epochs[member] = epoch
+            self.cond.notify_all()
+
+    def _newest(self):
+        return max(self.epochs.values()) if self.epochs else -1
+
+    def wait(self):
+        """
+        Wait for the next epoch to complete
+        :return: (epoch, list of members at that epoch). The epoch is None
+        when no new samples have been published within the interval +
+        timeout, and the member list is partial when the deadline expired
+        """
+
+        idle_deadline = time.time() + self.interval + self.timeout
+
+        with self.cond:
+            while True:
+                newest = self._newest()
+                now = time.time()
+
+                if newest <= self.released and self.closed:
+                    break
+
+                if newest > self.released:
+                    if min(self.epochs.values()) >= newest:
+                        break
+                    deadline = self.first_seen.get(newest, now) + self.timeout
+                else:
+                    deadline = idle_deadline
+
+                if now >= deadline:
+                    break
+
+                self.cond.wait(deadline - now)
+
+            if newest <= self.released:
+                return None, []
+
+            ready = [member for member in self.epochs
+                     if self.epochs[member] >= newest]
+
+            self.released = newest
+            self.cond.notify_all()
+            for epoch in [epoch for epoch in self.first_seen
+                          if epoch <= newest]:
+                del self.first_seen[epoch]
+
+            return newest, ready
+
+    def wait_released(self, epoch):
+        """
+        Block a publisher until the consumer has taken the given epoch
+        (used when samples are provided faster than real time)
+        """
+
+        with self.cond:
+            while self.released < epoch and not self.closed:
+                self.cond.wait(1.0)
+
+    def close(self):
+        """ no more samples will be published """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
@@ -31,3 +31,13 @@ def bytes2human(in_bytes, target_unit=None):
             return fmt_string.format(size, suffix)
 
     raise ValueError('number too large')
+
+
+def clients2text(clients):
+    """
+    Convert the list of clients a LUN is mapped to, into a display string
+    :param clients: list of client names
+    :return: comma separated string of client names
+    """
+
+    return ','.join(clients)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import re
+
+
+class DeviceFilter(object):
+    """
+    Device name filter built from one or more include and exclude regex
+    patterns. The patterns are compiled once, and the device set is only
+    evaluated against them when it changes (startup, LUN add/remove), giving
+    a cached index of the eligible LUNs
+    """
+
+    def __init__(self, include=None, exclude=None):
+        """
+        :param include: list of regex patterns - a device must match one
+        :param exclude: list of regex patterns - a device must match none
+        """
+
+        self.include_patterns = include or ['.*']
+        self.exclude_patterns = exclude or []
+        self.include = [re.compile(pattern) for pattern in self.include_patterns]
+        self.exclude = [re.compile(pattern) for pattern in self.exclude_patterns]
+
+        self.devices = []           # sorted device names
+        self.index = {}             # device name -> position in devices
+        self.eligible = []          # indices into devices that pass the filter
+        self.eligible_names = set()
+        self._source = None
+        self._state = None
+
+    @property
+    def active(self):
+        """ True if the filter excludes anything """
+        return self.include_patterns != ['.*'] or bool(self.exclude)
+
+    def match(self, devname):
+        return (any(regex.search(devname) for regex in self.include) and
+                not any(regex.search(devname) for regex in self.exclude))
+
+    def update(self, devices, generation=0):
+        """
+        Re-evaluate the filter if the device set has changed
+        :param devices: device dict (or list of names)
+        :param generation: change counter, bumped when devices are changed
+        without the number of devices changing
+        :return: (sorted device names, list of eligible indices)
+        """
+
+        state = (len(devices), generation)
+        if devices is not self._source or state != self._state:
+            self.devices = sorted(devices)
+            self.index = dict((devname, idx) for idx, devname
+                              in enumerate(self.devices))
+            self.eligible = [idx for idx, devname in enumerate(self.devices)
+                             if self.match(devname)]
+            self.eligible_names = set(self.devices[idx]
+                                      for idx in self.eligible)
+            self._source = devices
+            self._state = state
+
+        return self.devices, self.eligible
+
+    def describe(self):
+        """ return a description of the filter for display """
+        text = ','.join(self.include_patterns)
+        if self.exclude_patterns:
+            text += " excluding {}".format(','.join(self.exclude_patterns))
+        return text
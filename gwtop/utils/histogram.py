@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import math
+from array import array
+
+# number of samples the latency percentiles are taken over
+LATENCY_WINDOW = 60
+
+# latency buckets are log scaled; 4 buckets per doubling from 0.1ms, so the
+# error of a reported percentile is at most ~19%. Anything above the last
+# bound (~6.5s) is counted in the last bucket
+BUCKET_BASE = 0.1
+BUCKETS_PER_DOUBLING = 4
+NUM_BUCKETS = 64
+BUCKET_BOUNDS = [BUCKET_BASE * 2 ** (float(idx) / BUCKETS_PER_DOUBLING)
+                 for idx in range(NUM_BUCKETS)]
+
+PERCENTILES = (50, 95, 99)
+
+
+def bucket_for(value):
+    """ return the histogram bucket for a latency (ms) """
+    if value <= BUCKET_BASE:
+        return 0
+    idx = int(math.ceil(math.log(value / BUCKET_BASE, 2) *
+                        BUCKETS_PER_DOUBLING))
+    return min(idx, NUM_BUCKETS - 1)
+
+
+class LatencyWindow(object):
+    """
+    Per LUN latency histograms for a single gateway, covering the last
+    'window' samples. Each sample adds the interval's average latency to the
+    LUN's histogram, weighted by the number of I/Os in the interval, and
+    removes the sample that has dropped out of the window. Memory is fixed
+    per LUN (NUM_BUCKETS counts + the window ring)
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.names = []
+        self.index = {}                 # LUN name -> row
+        self.counts = array('i')        # row x NUM_BUCKETS
+        self.totals = array('i')        # I/Os held per row
+        self.ring_bucket = array('b')   # row x window, -1 = no I/O
+        self.ring_ios = array('i')      # row x window
+        self.pos = 0
+
+    def add_row(self, name):
+        if name in self.index:
+            return self.index[name]
+
+        row = len(self.names)
+        self.counts.extend(array('i', [0]) * NUM_BUCKETS)
+        self.totals.append(0)
+        self.ring_bucket.extend(array('b', [-1]) * self.window)
+        self.ring_ios.extend(array('i', [0]) * self.window)
+
+        self.index[name] = row
+        self.names.append(name)
+        return row
+
+    def add_sample(self, devices, latency, ios):
+        """
+        Add a sample to the histograms
+        :param devices: LUN names
+        :param latency: average latency (ms) of each LUN for the interval
+        :param ios: number of I/Os of each LUN for the interval
+        """
+
+        pos = self.pos
+        window = self.window
+        counts = self.counts
+        totals = self.totals
+        ring_bucket = self.ring_bucket
+        ring_ios = self.ring_ios
+
+        # expire the oldest sample of every row (including LUNs missing from
+        # this sample)
+        for row in xrange(len(self.names)):
+            slot = row * window + pos
+            old_bucket = ring_bucket[slot]
+            if old_bucket >= 0:
+                old_ios = ring_ios[slot]
+                counts[row * NUM_BUCKETS + old_bucket] -= old_ios
+                totals[row] -= old_ios
+                ring_bucket[slot] = -1
+                ring_ios[slot] = 0
+
+        index = self.index
+        for name, value, io_count in zip(devices, latency, ios):
+            io_count = int(round(io_count))
+            if io_count <= 0 or value <= 0:
+                # no I/O, or no latency reported for the LUN (e.g. the lio
+                # LUNs of the combined provider)
+                continue
+
+            row = index[name] if name in index else self.add_row(name)
+            bucket = bucket_for(value)
+            slot = row * window + pos
+
+            ring_bucket[slot] = bucket
+            ring_ios[slot] = io_count
+            counts[row * NUM_BUCKETS + bucket] += io_count
+            totals[row] += io_count
+
+        self.pos = (pos + 1) % window
+
+    def histogram(self, name):
+        """ return the bucket counts for a LUN, or None if it has no I/O """
+        row = self.index.get(name)
+        if row is None or not self.totals[row]:
+            return None
+        base = row * NUM_BUCKETS
+        return self.counts[base:base + NUM_BUCKETS]
+
+
+class LatencyTracker(object):
+    """
+    Latency histograms for every gateway. Each gateway has it's own
+    LatencyWindow, and the percentiles of a LUN are taken from the merged
+    (summed) histograms of all the gateways
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.gateways = {}
+
+    def add_sample(self, gateway, devices, latency, ios):
+        if gateway not in self.gateways:
+            self.gateways[gateway] = LatencyWindow(self.window)
+        self.gateways[gateway].add_sample(devices, latency, ios)
+
+    def percentiles(self, name, percentiles=PERCENTILES):
+        """
+        Return the latency percentiles for a LUN over the window
+        :param name: LUN name
+        :param percentiles: sequence of percentiles required (ascending)
+        :return: list of latencies (ms), the upper bound of the bucket
+        holding each percentile (0.0 when there's no I/O)
+        """
+
+        merged = None
+        for gateway in self.gateways.values():
+            counts = gateway.histogram(name)
+            if counts is None:
+                continue
+            if merged is None:
+                merged = list(counts)
+            else:
+                merged = map(sum, zip(merged, counts))
+
+        if merged is None:
+            return [0.0] * len(percentiles)
+
+        total = sum(merged)
+        targets = [total * pct / 100.0 for pct in percentiles]
+        values = []
+        cumulative = 0
+        bucket = 0
+        for target in targets:
+            while bucket < NUM_BUCKETS - 1 and \
+                    cumulative + merged[bucket] < target:
+                cumulative += merged[bucket]
+                bucket += 1
+            values.append(BUCKET_BOUNDS[bucket])
+
+        return values
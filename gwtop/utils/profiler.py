@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import ctypes
+import ctypes.util
+import os
+import threading
+import time
+from collections import deque
+
+CLOCK_MONOTONIC = 1
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long),
+                ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime():
+    """ return a monotonic clock function, using clock_gettime via ctypes """
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        # no monotonic clock available, so fall back to wall clock time
+        return time.time
+
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        ts = _timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(ts)) != 0:
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+    return monotonic
+
+
+monotonic = getattr(time, 'monotonic', None) or _clock_gettime()
+
+# stages shown in the status line, in pipeline order
+PIPELINE = ['fetch', 'extract', 'sync', 'summarize', 'sort', 'render']
+
+
+class StageStats(object):
+    """ rolling statistics of the elapsed time of a stage """
+
+    def __init__(self, window):
+        self.times = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.times.append(elapsed)
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    @property
+    def last(self):
+        return self.times[-1] if self.times else 0.0
+
+    @property
+    def mean(self):
+        return sum(self.times) / len(self.times) if self.times else 0.0
+
+    def percentile(self, pct):
+        if not self.times:
+            return 0.0
+        ordered = sorted(self.times)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+class Profiler(object):
+    """
+    Time the stages of the gwtop pipeline. Stages are timed with a
+    monotonic clock, and the most recent 'window' times of each stage are
+    kept for the rolling statistics. When disabled, recording is a no-op
+    """
+
+    def __init__(self, enabled=False, window=60):
+        self.enabled = enabled
+        self.window = window
+        self.stats = {}
+        self.lock = threading.Lock()
+
+        self.start_time = monotonic()
+        self.cpu_mark = (self.start_time, self._cpu_time())
+        self.cpu_pct = 0.0
+
+    @staticmethod
+    def _cpu_time():
+        user, system = os.times()[:2]
+        return user + system
+
+    def record(self, stage, elapsed):
+        """
+        Record the elapsed time of a stage
+        :param stage: stage name. Per gateway stages are named
+        <stage>:<gateway>, and are also recorded against the stage
+        :param elapsed: secs
+        """
+
+        if not self.enabled:
+            return
+
+        names = [stage]
+        if ':' in stage:
+            names.append(stage.split(':')[0])
+
+        with self.lock:
+            for name in names:
+                if name not in self.stats:
+                    self.stats[name] = StageStats(self.window)
+                self.stats[name].add(elapsed)
+
+    def wrap(self, stage, func):
+        """ return func, timed as the given stage """
+
+        def timed(*args, **kwargs):
+            start = monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, monotonic() - start)
+
+        return timed
+
+    def cpu_percent(self):
+        """ return gwtop's cpu utilisation since the last call """
+
+        now = monotonic()
+        cpu = self._cpu_time()
+        elapsed = now - self.cpu_mark[0]
+        if elapsed >= 1:
+            self.cpu_pct = (cpu - self.cpu_mark[1]) / elapsed * 100
+            self.cpu_mark = (now, cpu)
+        return self.cpu_pct
+
+    def status_line(self):
+        """ return a one line summary of the mean stage times and cpu """
+
+        with self.lock:
+            stages = ["{} {:.1f}".format(stage,
+                                         self.stats[stage].mean * 1000)
+                      for stage in PIPELINE if stage in self.stats]
+
+        return "Profile(ms): {}   CPU: {:.1f}%".format('  '.join(stages),
+                                                      self.cpu_percent())
+
+    def dump(self, out):
+        """ write the stage statistics to out """
+
+        if not self.enabled:
+            return
+
+        runtime = monotonic() - self.start_time
+        cpu = self._cpu_time()
+
+        out.write("\ngwtop profile - {:.0f}s elapsed, {:.1f}s cpu "
+                  "({:.1f}%)\n".format(runtime, cpu,
+                                       cpu / runtime * 100 if runtime else 0))
+        out.write("{:<24} {:>8} {:>10} {:>10} {:>10} {:>10}\n".format(
+                  "stage", "count", "last ms", "mean ms", "p95 ms", "max ms"))
+
+        with self.lock:
+            order = ([stage for stage in PIPELINE if stage in self.stats] +
+                     sorted(stage for stage in self.stats
+                            if stage not in PIPELINE))
+            for stage in order:
+                stats = self.stats[stage]
+                out.write("{:<24} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} "
+                          "{:>10.2f}\n".format(stage,
+                                               stats.count,
+                                               stats.last * 1000,
+                                               stats.mean * 1000,
+                                               stats.percentile(95) * 1000,
+                                               stats.max * 1000))
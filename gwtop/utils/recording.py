@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import json
+import struct
+import sys
+import threading
+import Queue
+from array import array
+
+# Recording file layout
+#
+#   magic (8 bytes) 'GWTOPREC'
+#   header length (uint32) + header (json) - provider, interval, gateways,
+#                   metric names and the LUN dictionary
+#   records, each starting with a 1 byte type
+#     'L' - LUN dictionary addition; length (uint32) + json LUN definition
+#     'S' - sample; SAMPLE_HDR followed by the LUN ids of the active LUNs
+#           (uint32 each) and a fixed width row of float32 values per LUN,
+#           one value per metric in header order
+#
+# Numeric arrays are written in the byte order of the recording host, which
+# is declared in the header
+
+MAGIC = 'GWTOPREC'
+VERSION = 1
+
+# timestamp, epoch, gateway index, cpu busy %, nic in/out bytes, active luns
+SAMPLE_HDR = struct.Struct('<dqHfddI')
+LENGTH = struct.Struct('<I')
+
+
+class RecordingError(Exception):
+    pass
+
+
+class Recorder(threading.Thread):
+    """
+    Append every sample published by the collectors to a recording file.
+    The collector threads only queue a copy of the sample's columns, the
+    encoding and file I/O is done by this thread
+    """
+
+    def __init__(self, filename, config, collectors):
+        """
+        :param filename: file to write the recording to
+        :param config: runtime config object (devices, gateway_config)
+        :param collectors: list of collector objects that will be recorded
+        """
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue.Queue()
+        self.file = open(filename, 'wb')
+
+        self.gateways = [collector.hostname for collector in collectors]
+        self.metrics = sorted(collectors[0].disk_attr)
+
+        self.lun_ids = {}               # lun name -> lun id
+        self.row_map = dict((gw, array('l')) for gw in self.gateways)
+
+        luns = [self._lun_defn(config, name) for name in sorted(config.devices)]
+        for lun in luns:
+            self.lun_ids[lun['name']] = len(self.lun_ids)
+
+        header = {"version": VERSION,
+                  "byteorder": sys.byteorder,
+                  "provider": config.opts.provider,
+                  "interval": config.sample_interval,
+                  "gateways": self.gateways,
+                  "metrics": self.metrics,
+                  "luns": luns,
+                  "clients": config.gateway_config.diskmap,
+                  "client_count": config.gateway_config.client_count}
+
+        self.config = config
+        self.file.write(MAGIC)
+        self._write_blob(json.dumps(header))
+        self.file.flush()
+
+    @staticmethod
+    def _lun_defn(config, name):
+        device = config.devices.get(name, {})
+        return {"name": name,
+                "size": device.get('size', 0),
+                "rbd_name": device.get('rbd_name', '')}
+
+    def _write_blob(self, data):
+        self.file.write(LENGTH.pack(len(data)))
+        self.file.write(data)
+
+    def update(self, metrics):
+        """
+        listener entry point, called in the collector's thread each time a
+        sample is published
+        """
+
+        samples = metrics.samples
+        slot = samples.slot
+        rows = len(samples)
+        columns = [samples.column(metric, slot, rows)
+                   for metric in self.metrics]
+
+        self.queue.put((metrics.hostname,
+                        samples.timestamps[slot],
+                        samples.epochs[slot],
+                        metrics.cpu_busy_pct,
+                        metrics.nic_bytes['in'],
+                        metrics.nic_bytes['out'],
+                        samples.names[:rows],
+                        columns))
+
+    def _lun_rows(self, gateway, names):
+        """ return the row -> lun id map for a gateway's sample ring """
+
+        row_map = self.row_map[gateway]
+        for name in names[len(row_map):]:
+            if name not in self.lun_ids:
+                self.lun_ids[name] = len(self.lun_ids)
+                self.file.write('L')
+                self._write_blob(json.dumps(self._lun_defn(self.config,
+                                                           name)))
+            row_map.append(self.lun_ids[name])
+        return row_map
+
+    def write_sample(self, gateway, timestamp, epoch, cpu, nic_in, nic_out,
+                     names, columns):
+
+        row_map = self._lun_rows(gateway, names)
+
+        # only LUNs doing I/O are written to the recording
+        iops = columns[self.metrics.index('iops')]
+        active = [row for row, value in enumerate(iops) if value]
+
+        lun_ids = array('I', [row_map[row] for row in active])
+        values = array('f', [0.0]) * (len(active) * len(self.metrics))
+        num_metrics = len(self.metrics)
+        for offset, column in enumerate(columns):
+            values[offset::num_metrics] = array('f', [column[row]
+                                                      for row in active])
+
+        self.file.write('S')
+        self.file.write(SAMPLE_HDR.pack(timestamp, epoch,
+                                        self.gateways.index(gateway),
+                                        cpu, nic_in, nic_out, len(active)))
+        self.file.write(lun_ids.tostring())
+        self.file.write(values.tostring())
+
+    def run(self):
+        while True:
+            sample = self.queue.get()
+
+            # drain anything else that's waiting before flushing the file
+            while sample is not None:
+                self.write_sample(*sample)
+                if self.queue.empty():
+                    break
+                sample = self.queue.get()
+            self.file.flush()
+
+            if sample is None:
+                # closed
+                break
+
+    def close(self):
+        """
+        Write the samples still queued and close the recording, called on
+        shutdown
+        """
+
+        self.queue.put(None)
+        self.join()
+        self.file.close()
+
+
+class RecordingReader(object):
+    """
+    Read a recording created by the Recorder
+    """
+
+    def __init__(self, filename):
+
+        self.file = open(filename, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise RecordingError("{} is not a gwtop recording".format(filename))
+
+        self.header = json.loads(self._read_blob())
+        if self.header.get('version') != VERSION:
+            raise RecordingError("Unsupported recording version "
+                                 "({})".format(self.header.get('version')))
+
+        self.provider = self.header['provider']
+        self.interval = self.header['interval']
+        self.gateways = self.header['gateways']
+        self.metrics = self.header['metrics']
+        self.luns = self.header['luns']
+        self.swap = self.header['byteorder'] != sys.byteorder
+
+    def _read(self, length):
+        data = self.file.read(length)
+        if len(data) != length:
+            # a partially written record at the end of the recording
+            raise EOFError
+        return data
+
+    def _read_blob(self):
+        length, = LENGTH.unpack(self._read(LENGTH.size))
+        return self._read(length)
+
+    def _read_array(self, typecode, count):
+        values = array(typecode)
+        values.fromstring(self._read(values.itemsize * count))
+        if self.swap:
+            values.byteswap()
+        return values
+
+    @property
+    def devices(self):
+        """ device dict (name -> size/rbd_name) of the recorded LUNs """
+        return dict((lun['name'], {"size": lun['size'],
+                                   "rbd_name": lun['rbd_name']})
+                    for lun in self.luns)
+
+    def samples(self):
+        """
+        Generator returning each gateway sample in the recording. LUN
+        dictionary records are applied to self.luns as they are read
+        :return: tuple - gateway index, timestamp, epoch, cpu busy %,
+        nic in, nic out, lun ids (array), values (array, a row of metric
+        values per lun id)
+        """
+
+        num_metrics = len(self.metrics)
+        try:
+            while True:
+                rec_type = self.file.read(1)
+                if not rec_type:
+                    break
+
+                if rec_type == 'L':
+                    self.luns.append(json.loads(self._read_blob()))
+                elif rec_type == 'S':
+                    (timestamp, epoch, gw_idx, cpu, nic_in, nic_out,
+                     num_luns) = SAMPLE_HDR.unpack(self._read(SAMPLE_HDR.size))
+                    lun_ids = self._read_array('I', num_luns)
+                    values = self._read_array('f', num_luns * num_metrics)
+                    yield (gw_idx, timestamp, epoch, cpu, nic_in, nic_out,
+                           lun_ids, values)
+                else:
+                    raise RecordingError("Unknown record type "
+                                         "'{}'".format(rec_type))
+        except EOFError:
+            pass
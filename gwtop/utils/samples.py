@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+from array import array
+
+# default number of samples retained by each collector. summarize takes the
+# sample for an epoch, or one either side of it, while the collector may be
+# writing the next sample - so only a few slots are ever in use
+SAMPLE_HISTORY = 3
+
+
+class SampleRing(object):
+    """
+    Fixed capacity, columnar store of the most recent samples taken by a
+    collector. Each metric is held in a single preallocated array of doubles
+    laid out as rows (LUN index) x columns (sample slot), so taking a sample
+    simply overwrites the oldest slot in place
+    """
+
+    def __init__(self, metrics, names=None, capacity=SAMPLE_HISTORY):
+        """
+        Create the ring
+        :param metrics: list of metric names to hold for each LUN
+        :param names: initial LUN names, defining the row sequence
+        :param capacity: number of samples to retain (>=2)
+        """
+
+        if capacity < 2:
+            raise ValueError("sample ring capacity must be at least 2")
+
+        self.metrics = list(metrics)
+        self.capacity = capacity
+        self.names = []             # row -> LUN name
+        self.index = {}             # LUN name -> row
+        self.data = dict((metric, array('d')) for metric in self.metrics)
+
+        self.timestamps = array('d', [0.0]) * capacity
+        self.epochs = array('l', [-1]) * capacity
+
+        self.slot = -1              # last committed slot (-1 = no data)
+        self.write_slot = 0         # slot the next sample is written to
+        self.count = 0              # total samples committed
+        self._zeros = array('d')
+
+        for name in (names or []):
+            self.add_row(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_row(self, name):
+        """
+        Add a LUN to the ring, returning it's row number. Existing rows are
+        never renumbered
+        :param name: LUN name
+        :return: row number (int)
+        """
+
+        if name in self.index:
+            return self.index[name]
+
+        row = len(self.names)
+        pad = array('d', [0.0]) * self.capacity
+        for metric in self.metrics:
+            self.data[metric].extend(pad)
+        self._zeros.append(0.0)
+
+        self.index[name] = row
+        self.names.append(name)
+        return row
+
+    def begin(self):
+        """
+        Prepare the next slot for a new sample, zeroing every LUN so devices
+        missing from the sample don't inherit stale values
+        """
+
+        rows = len(self.names)
+        cap = self.capacity
+        ws = self.write_slot
+        zeros = self._zeros[:rows]
+        for metric in self.metrics:
+            self.data[metric][ws:rows * cap:cap] = zeros
+
+    def put(self, metric, row, value):
+        """ store a value for the sample currently being written """
+        self.data[metric][row * self.capacity + self.write_slot] = value
+
+    def commit(self, timestamp, epoch=-1):
+        """
+        Publish the sample being written, making it the latest sample
+        :param timestamp: sample time (secs since the epoch, float)
+        :param epoch: sample sequence number shared by all gateways
+        """
+
+        ws = self.write_slot
+        self.timestamps[ws] = timestamp
+        self.epochs[ws] = epoch
+        self.slot = ws
+        self.count += 1
+        self.write_slot = (ws + 1) % self.capacity
+
+    def column(self, metric, slot=None, rows=None):
+        """
+        Return the values of a metric for every LUN in a given sample slot
+        :param metric: metric name
+        :param slot: sample slot (defaults to the latest sample)
+        :param rows: number of rows to return (defaults to all rows)
+        :return: array of doubles, indexed by row
+        """
+
+        slot = self.slot if slot is None else slot
+        rows = len(self.names) if rows is None else rows
+        if slot < 0:
+            return self._zeros[:rows]
+        return self.data[metric][slot:rows * self.capacity:self.capacity]
+
+    def slots(self):
+        """ return the committed slot numbers, oldest first """
+        available = min(self.count, self.capacity)
+        first = self.slot - available + 1
+        return [(first + n) % self.capacity for n in range(available)]
+
+    def slot_for_epoch(self, epoch, tolerance=0, after=None):
+        """
+        Return the slot holding a given epoch, or None
+        :param epoch: epoch number to look for
+        :param tolerance: accept the closest epoch within this distance when
+        the exact epoch is not held (e.g. sampling jitter skipped it)
+        :param after: only consider the epochs after this one (i.e. the
+        samples that haven't already been consumed)
+        :return: slot number or None
+        """
+
+        nearest = None
+        for slot in reversed(self.slots()):
+            if after is not None and self.epochs[slot] <= after:
+                break
+            distance = abs(self.epochs[slot] - epoch)
+            if distance == 0:
+                return slot
+            if distance <= tolerance and nearest is None:
+                nearest = slot
+        return nearest
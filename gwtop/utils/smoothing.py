@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+__author__ = 'paul'
+
+import math
+from array import array
+
+# window averages (minutes) and the time constant of the ewma (secs)
+WINDOWS = (1, 5, 15)
+EWMA_PERIOD = 60
+
+RATE_CHOICES = ['interval', 'ewma'] + ['{}m'.format(w) for w in WINDOWS]
+
+
+class RateSmoother(object):
+    """
+    Maintain smoothed values of a set of metrics for a set of names (LUNs or
+    gateways) - an exponentially weighted moving average, and averages over
+    the last 1, 5 and 15 minutes. The window averages are held as per minute
+    bucket sums, so each sample is O(1) per name and metric and the memory
+    used is fixed. A window average covers the last n complete minutes plus
+    the current (partial) minute
+    """
+
+    def __init__(self, metrics, interval):
+        """
+        :param metrics: metric names to smooth
+        :param interval: secs between samples
+        """
+
+        self.metrics = list(metrics)
+        self.alpha = 1 - math.exp(-float(interval) / EWMA_PERIOD)
+        self.bucket_samples = max(1, int(round(60.0 / interval)))
+
+        # one more bucket than the longest window, so the bucket leaving a
+        # window is still held when the window is updated
+        self.num_buckets = max(WINDOWS) + 1
+        self.current = 0
+        self.bucket_counts = array('i', [0]) * self.num_buckets
+        self.window_counts = dict((window, 0) for window in WINDOWS)
+
+        self.names = []
+        self.index = {}
+        self.primed = array('b')
+        self.ewma = dict((metric, array('d')) for metric in self.metrics)
+        self.buckets = dict((metric, array('d')) for metric in self.metrics)
+        self.window_sums = dict(((metric, window), array('d'))
+                                for metric in self.metrics
+                                for window in WINDOWS)
+
+        # smoothed field name -> (metric, window), with a window of None
+        # for the ewma
+        self.field_map = {}
+        for metric in self.metrics:
+            self.field_map['{}_ewma'.format(metric)] = (metric, None)
+            for window in WINDOWS:
+                self.field_map['{}_{}m'.format(metric, window)] = (metric,
+                                                                   window)
+        self.field_names = sorted(self.field_map)
+
+    def add_row(self, name):
+        if name in self.index:
+            return self.index[name]
+
+        row = len(self.names)
+        self.primed.append(0)
+        for metric in self.metrics:
+            self.ewma[metric].append(0.0)
+            self.buckets[metric].extend(array('d', [0.0]) * self.num_buckets)
+            for window in WINDOWS:
+                self.window_sums[(metric, window)].append(0.0)
+
+        self.index[name] = row
+        self.names.append(name)
+        return row
+
+    def update(self, names, values):
+        """
+        Add a sample
+        :param names: sequence of names (LUNs/gateways) in the sample
+        :param values: dict of metric name -> sequence of values, in the
+        same sequence as names
+        """
+
+        index = self.index
+        rows = [index[name] if name in index else self.add_row(name)
+                for name in names]
+
+        alpha = self.alpha
+        num_buckets = self.num_buckets
+        current = self.current
+        primed = self.primed
+
+        for metric in self.metrics:
+            ewma = self.ewma[metric]
+            buckets = self.buckets[metric]
+            for row, value in zip(rows, values[metric]):
+                if primed[row]:
+                    ewma[row] += alpha * (value - ewma[row])
+                else:
+                    ewma[row] = value
+                buckets[row * num_buckets + current] += value
+
+        for row in rows:
+            primed[row] = 1
+
+        self.bucket_counts[current] += 1
+        if self.bucket_counts[current] >= self.bucket_samples:
+            self._rollover()
+
+    def _rollover(self):
+        """
+        The current minute is complete, so add it to each window and drop
+        the minute that has aged out of the window
+        """
+
+        num_buckets = self.num_buckets
+        current = self.current
+        rows = len(self.names)
+
+        for window in WINDOWS:
+            leaving = (current - window) % num_buckets
+            self.window_counts[window] += (self.bucket_counts[current] -
+                                           self.bucket_counts[leaving])
+            for metric in self.metrics:
+                buckets = self.buckets[metric]
+                sums = self.window_sums[(metric, window)]
+                for row in xrange(rows):
+                    base = row * num_buckets
+                    sums[row] += buckets[base + current] - buckets[base + leaving]
+
+        # the next bucket has now left every window, so it can be reused
+        self.current = (current + 1) % num_buckets
+        self.bucket_counts[self.current] = 0
+        for metric in self.metrics:
+            buckets = self.buckets[metric]
+            for row in xrange(rows):
+                buckets[row * num_buckets + self.current] = 0.0
+
+    def fields(self, name):
+        """
+        Return the smoothed values for a name
+        :param name: LUN/gateway name
+        :return: dict of <metric>_ewma and <metric>_<n>m values
+        """
+
+        columns = self.columns([name])
+        return dict((field, values[0]) for field, values in columns.items())
+
+    def columns(self, names, fields=None):
+        """
+        Return the smoothed values of a set of names, a field at a time
+        :param names: sequence of LUN/gateway names
+        :param fields: smoothed field names required e.g. iops_5m (default
+        is every field)
+        :return: dict of field name -> list of values in names sequence.
+        Names without any samples have a value of 0.0
+        """
+
+        index = self.index
+        rows = [index.get(name) for name in names]
+        num_buckets = self.num_buckets
+        current = self.current
+        partial = self.bucket_counts[current]
+
+        columns = {}
+        for field in (self.field_names if fields is None else fields):
+            metric, window = self.field_map[field]
+            if window is None:
+                ewma = self.ewma[metric]
+                columns[field] = [ewma[row] if row is not None else 0.0
+                                  for row in rows]
+                continue
+
+            count = self.window_counts[window] + partial
+            if not count:
+                columns[field] = [0.0] * len(rows)
+                continue
+
+            buckets = self.buckets[metric]
+            sums = self.window_sums[(metric, window)]
+            count = float(count)
+            columns[field] = [(sums[row] +
+                               buckets[row * num_buckets + current]) / count
+                              if row is not None else 0.0
+                              for row in rows]
+
+        return columns